@@ -0,0 +1,144 @@
+import struct
+
+import numpy as np
+
+from fuzzy_index import FuzzyIndex, BACKEND_NUMPY
+
+# Fixed layout binary format for one artist's search data. The same bytes are stored in the artist store
+# and in the shared memory cache, and are queried in place -- nothing gets unpickled or written
+# to temp files on a cache hit.
+#
+#   header:   magic, format version, flags, number of sections
+#   sections: (offset, count) for each entry in SECTIONS, in order
+#   data:     each section's array, 8 byte aligned
+#
+# The vocabulary is stored as sorted trigram codes, see trigram_vectorizer.py.
+#
+# The recording and release tables map an index document (a unique encoded name) to the rows it stands
+# for: rows for document i are [offsets[i], offsets[i+1]).
+
+MAGIC = b"FFAD"
+FORMAT_VERSION = 4
+FLAG_EMPTY = 1
+
+HEADER = struct.Struct("<4sIII")
+SECTION = struct.Struct("<QQ")
+
+INDEX_SECTIONS = (("vocab", "<i8"),
+                  ("idf", "<f8"),
+                  ("indptr", "<i8"),
+                  ("indices", "<i4"),
+                  ("data", "<f4"),
+                  ("ids", "<i8"),
+                  ("text_offsets", "<i8"),
+                  ("text", "u1"))
+
+SECTIONS = tuple([("recording_" + name, dtype) for name, dtype in INDEX_SECTIONS] +
+                 [("release_" + name, dtype) for name, dtype in INDEX_SECTIONS] +
+                 [("recording_offsets", "<i8"),
+                  ("recording_recording_ids", "<i8"),
+                  ("recording_release_ids", "<i8"),
+                  ("recording_scores", "<i8"),
+                  ("release_offsets", "<i8"),
+                  ("release_release_ids", "<i8"),
+                  ("release_scores", "<i8")])
+
+
+def pack_artist_data(recording_index=None, release_index=None, tables=None):
+    """
+        Pack an artist's fitted indexes and lookup tables into bytes. tables holds the recording_* and
+        release_* row arrays from search_index.artist_documents(). If either index is missing, an empty
+        entry is written so that we don't keep trying to build it.
+    """
+
+    arrays = {}
+    flags = 0
+    if recording_index is None or release_index is None:
+        flags |= FLAG_EMPTY
+    else:
+        for name, value in recording_index.to_arrays().items():
+            arrays["recording_" + name] = value
+        for name, value in release_index.to_arrays().items():
+            arrays["release_" + name] = value
+        arrays.update(tables)
+
+    offset = HEADER.size + SECTION.size * len(SECTIONS)
+    table = []
+    chunks = []
+    for name, dtype in SECTIONS:
+        array = np.ascontiguousarray(arrays.get(name, np.empty(0)), dtype=dtype)
+        offset += -offset % 8
+        table.append(SECTION.pack(offset, len(array)))
+        chunks.append((offset, array.tobytes()))
+        offset += array.nbytes
+
+    buf = bytearray(offset)
+    HEADER.pack_into(buf, 0, MAGIC, FORMAT_VERSION, flags, len(SECTIONS))
+    buf[HEADER.size:HEADER.size + SECTION.size * len(SECTIONS)] = b"".join(table)
+    for start, data in chunks:
+        buf[start:start + len(data)] = data
+
+    return bytes(buf)
+
+
+def doc_rows(offsets, docs):
+    """
+        Return the rows of an array of documents, whose rows are [offsets[i], offsets[i + 1]), in document
+        order, and for each row the position of its document in docs
+    """
+
+    starts = offsets[docs]
+    counts = offsets[docs + 1] - starts
+    positions = np.repeat(np.arange(len(docs)), counts)
+    rows = np.arange(int(counts.sum())) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return rows, positions
+
+
+class ArtistData:
+    """
+        Read-only view of a packed artist entry. All arrays reference the passed buffer (bytes, mmap or
+        a shared memory buffer) without copying it.
+    """
+
+    def __init__(self, buf):
+        magic, version, flags, num_sections = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or num_sections != len(SECTIONS):
+            raise ValueError("Buffer does not contain packed artist data.")
+
+        self.buffer = buf
+        self.arrays = {}
+        for i, (name, dtype) in enumerate(SECTIONS):
+            offset, count = SECTION.unpack_from(buf, HEADER.size + SECTION.size * i)
+            self.arrays[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+
+        self.recording_index = None
+        self.release_index = None
+        if flags & FLAG_EMPTY:
+            return
+
+        # The numpy backend searches the packed matrix as it is, any other backend would build an index
+        # every time the data is unpacked
+        self.recording_index = FuzzyIndex(backend=BACKEND_NUMPY)
+        self.recording_index.load_from_arrays({ name: self.arrays["recording_" + name] for name, _ in INDEX_SECTIONS })
+        self.release_index = FuzzyIndex(backend=BACKEND_NUMPY)
+        self.release_index.load_from_arrays({ name: self.arrays["release_" + name] for name, _ in INDEX_SECTIONS })
+
+    @property
+    def is_empty(self):
+        return self.recording_index is None
+
+    def recording_rows(self, docs):
+        """
+            Return the rows of an array of recording index documents as arrays: recording_ids, release_ids,
+            scores and the position in docs of each row's document
+        """
+
+        rows, positions = doc_rows(self.arrays["recording_offsets"], docs)
+        return (self.arrays["recording_recording_ids"][rows], self.arrays["recording_release_ids"][rows],
+                self.arrays["recording_scores"][rows], positions)
+
+    def release_rows(self, docs):
+        """ Return the rows of an array of release index documents as arrays: release_ids, scores and document positions """
+
+        rows, positions = doc_rows(self.arrays["release_offsets"], docs)
+        return self.arrays["release_release_ids"][rows], self.arrays["release_scores"][rows], positions
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+from collections import Counter
+from contextlib import contextmanager
+from hashlib import blake2b
+from multiprocessing import shared_memory
+import fcntl
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+from mapping_lookup import MappingLookup
+from shared_mem_cache import SHM_DIR, NAMESPACE
+
+# A cache of resolved artist names (the candidate artist ids and their confidences that
+# MappingLookup.resolve_artists() found for an artist string), shared by all server processes. The table
+# has NUM_SETS sets of WAYS entries and an artist string can only be kept in its set. When the set is full,
+# the entry that was added first is replaced.
+#
+# Writers lock the table. Readers don't: an entry's key is cleared before and set after it is written, and
+# a reader only uses what it copied if the key was still the same afterwards.
+
+NUM_SETS = 1 << 15
+WAYS = 4
+NUM_ENTRIES = NUM_SETS * WAYS
+# Resolutions with more candidates than this are not cached
+MAX_CANDIDATES = 32
+
+HEADER_STAMP, HEADER_ENTRIES = range(2)
+HEADER_FIELDS = 8
+
+# How many of the most frequent artists of a query log to resolve when warming the cache
+WARM_ARTISTS = NUM_ENTRIES // 2
+WARM_BATCH_SIZE = 1000
+
+
+class ArtistResolutionCache:
+    """ Shared memory cache of artist strings -> (candidate ids, confidences), see above """
+
+    def __init__(self, namespace=NAMESPACE):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.lock_fd = None
+        self.shm = None
+        self.header = None
+        self.keys = None
+
+    @contextmanager
+    def locked(self):
+        """ Lock the table against other writers, attaching to it first if needed """
+        with self.lock:
+            if self.lock_fd is None:
+                self.lock_fd = os.open(os.path.join(SHM_DIR, self.namespace + "resolved.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                if self.keys is None:
+                    self.attach()
+                yield
+            finally:
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_UN)
+
+    def attach(self):
+        """ Open the table, creating it if this is the first process to use it. Call with the lock held. """
+        size = (HEADER_FIELDS + NUM_ENTRIES * (3 + MAX_CANDIDATES)) * 8 + NUM_ENTRIES * MAX_CANDIDATES * 4
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.namespace + "resolved", create=True, size=size, track=False)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=self.namespace + "resolved", create=False, track=False)
+
+        offset = HEADER_FIELDS * 8
+        self.header = np.ndarray(HEADER_FIELDS, dtype=np.int64, buffer=self.shm.buf)
+        self.keys = np.ndarray(NUM_ENTRIES, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += NUM_ENTRIES * 8
+        self.stamps = np.ndarray(NUM_ENTRIES, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += NUM_ENTRIES * 8
+        self.counts = np.ndarray(NUM_ENTRIES, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += NUM_ENTRIES * 8
+        self.ids = np.ndarray((NUM_ENTRIES, MAX_CANDIDATES), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += NUM_ENTRIES * MAX_CANDIDATES * 8
+        self.confidences = np.ndarray((NUM_ENTRIES, MAX_CANDIDATES), dtype=np.float32, buffer=self.shm.buf, offset=offset)
+
+    def key(self, text):
+        """ Return the key of a string: a hash that is the same in all processes and never 0 (an empty entry) """
+        key = int.from_bytes(blake2b(text.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+        return key or 1
+
+    def get(self, text):
+        """ Return the (ids, confidences) lists cached for text, or None """
+        if self.keys is None:
+            with self.locked():
+                pass
+
+        key = self.key(text)
+        start = (key % NUM_SETS) * WAYS
+        for i in np.flatnonzero(self.keys[start:start + WAYS] == key).tolist():
+            i += start
+            count = int(self.counts[i])
+            ids = self.ids[i, :count].tolist()
+            confidences = self.confidences[i, :count].tolist()
+            if self.keys[i] == key:
+                return ids, confidences
+
+        return None
+
+    def put(self, text, ids, confidences):
+        """ Cache the resolution of text, unless it has too many candidates """
+        if len(ids) > MAX_CANDIDATES:
+            return
+
+        key = self.key(text)
+        start = (key % NUM_SETS) * WAYS
+        with self.locked():
+            keys = self.keys[start:start + WAYS]
+            if (keys == key).any():
+                return
+
+            empty = np.flatnonzero(keys == 0)
+            if len(empty):
+                i = start + int(empty[0])
+                self.header[HEADER_ENTRIES] += 1
+            else:
+                i = start + int(np.argmin(self.stamps[start:start + WAYS]))
+
+            self.keys[i] = 0
+            self.counts[i] = len(ids)
+            self.ids[i, :len(ids)] = ids
+            self.confidences[i, :len(ids)] = confidences
+            self.header[HEADER_STAMP] += 1
+            self.stamps[i] = self.header[HEADER_STAMP]
+            self.keys[i] = key
+
+    def clear(self):
+        with self.locked():
+            self.keys[:] = 0
+            self.header[:] = 0
+
+    def __len__(self):
+        with self.locked():
+            return int(self.header[HEADER_ENTRIES])
+
+
+def warm(index_dir, log_file, max_artists=WARM_ARTISTS):
+    """
+        Resolve the most frequent artists of a query log, one {"artist": ...} JSON object per line, into
+        the shared cache. The index dir must be the one the servers use.
+    """
+    counts = Counter()
+    with open(log_file, "r") as f:
+        for line in f:
+            if line.strip():
+                counts[json.loads(line)["artist"]] += 1
+
+    artists = [ artist for artist, count in counts.most_common(max_artists) ]
+    lookup = MappingLookup(index_dir, None, resolution_cache=ArtistResolutionCache())
+    for i in range(0, len(artists), WARM_BATCH_SIZE):
+        lookup.resolve_artists(artists[i:i + WARM_BATCH_SIZE])
+        print("Resolved %d of %d artists" % (min(i + WARM_BATCH_SIZE, len(artists)), len(artists)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: artist_resolution_cache.py <index dir> <query log> [max artists]")
+        sys.exit(-1)
+
+    warm(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else WARM_ARTISTS)
@@ -0,0 +1,123 @@
+import mmap
+import os
+import struct
+from array import array
+
+import numpy as np
+
+from artist_data import ArtistData
+
+# A read-only file of prebuilt artist entries, written by build_indexes.py and memory mapped by all server
+# processes, which share its pages through the page cache. An entry is looked up with one binary search over
+# the offset table, its data is used in place.
+#
+#   header:  magic, format version
+#   entries: the packed artist data of each artist, 8 byte aligned, in the order they were added
+#   table:   sorted artist_credit_ids, then the offset and the size of each entry (all int64)
+#   footer:  table offset, number of entries, magic
+#
+# The file is written under a temp name and renamed when complete, so readers only ever see whole files.
+
+STORE_FILE = "artist_store.dat"
+MAGIC = b"FFAS"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<4sI")
+FOOTER = struct.Struct("<QQ4s")
+
+
+class ArtistStoreWriter:
+    """ Append artist entries to a new store file, which replaces path when closed """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path + ".tmp", "wb")
+        self.f.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        self.offset = HEADER.size
+        self.ids = array("q")
+        self.offsets = array("q")
+        self.sizes = array("q")
+
+    def add(self, artist_credit_id, buffer):
+        pad = -self.offset % 8
+        self.f.write(b"\0" * pad)
+        self.offset += pad
+        self.f.write(buffer)
+        self.ids.append(artist_credit_id)
+        self.offsets.append(self.offset)
+        self.sizes.append(len(buffer))
+        self.offset += len(buffer)
+
+    def close(self):
+        ids = np.array(self.ids, dtype=np.int64)
+        # Sort by id. For an artist added more than once the last entry wins.
+        order = np.lexsort((-np.arange(len(ids)), ids))
+        ids = ids[order]
+        unique = np.ones(len(ids), dtype=bool)
+        unique[1:] = ids[1:] != ids[:-1]
+        order = order[unique]
+
+        pad = -self.offset % 8
+        self.f.write(b"\0" * pad)
+        table_offset = self.offset + pad
+        self.f.write(ids[unique].tobytes())
+        self.f.write(np.array(self.offsets, dtype=np.int64)[order].tobytes())
+        self.f.write(np.array(self.sizes, dtype=np.int64)[order].tobytes())
+        self.f.write(FOOTER.pack(table_offset, len(order), MAGIC))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.rename(self.path + ".tmp", self.path)
+
+
+class ArtistStore:
+    """ Memory mapped, read-only access to a store file """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self.buf, 0)
+        table_offset, count, footer_magic = FOOTER.unpack_from(self.buf, len(self.buf) - FOOTER.size)
+        if magic != MAGIC or footer_magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("%s is not an artist store." % path)
+
+        self.ids = np.frombuffer(self.buf, dtype=np.int64, count=count, offset=table_offset)
+        self.offsets = np.frombuffer(self.buf, dtype=np.int64, count=count, offset=table_offset + count * 8)
+        self.sizes = np.frombuffer(self.buf, dtype=np.int64, count=count, offset=table_offset + count * 16)
+
+    @staticmethod
+    def open(index_dir):
+        """ Open the store in index_dir, returns None if it has not been built """
+        try:
+            return ArtistStore(os.path.join(index_dir, STORE_FILE))
+        except FileNotFoundError:
+            return None
+
+    def replaced(self):
+        """ Return True if the store file has been replaced since it was opened """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_dev) != (self.stat.st_ino, self.stat.st_dev)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def items(self):
+        """ Iterate over (artist_credit_id, packed data) of all entries, in artist_credit_id order """
+        view = memoryview(self.buf)
+        for artist_credit_id, offset, size in zip(self.ids.tolist(), self.offsets.tolist(), self.sizes.tolist()):
+            yield artist_credit_id, view[offset:offset + size]
+
+    def get(self, artist_credit_id):
+        """ Return an artist's ArtistData, which references the mapped file, or None if it is not in the store """
+        i = np.searchsorted(self.ids, artist_credit_id)
+        if i == len(self.ids) or self.ids[i] != artist_credit_id:
+            return None
+
+        offset = int(self.offsets[i])
+        return ArtistData(memoryview(self.buf)[offset:offset + int(self.sizes[i])])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+from collections import defaultdict
+from random import Random
+from time import monotonic
+import os
+import sys
+
+import numpy as np
+from tabulate import tabulate
+
+from database import open_db, db
+from fuzzy_index import FuzzyIndex, BACKEND_NMSLIB, BACKEND_NUMPY
+
+# Upper bounds of the artist size buckets, in number of distinct recording names
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000)
+ARTISTS_PER_BUCKET = 20
+QUERIES_PER_ARTIST = 20
+MIN_CONFIDENCE = .5
+# Both backends compute in single precision, but add up in a different order: confidences may differ in the
+# last bits. They are compared with np.allclose()'s default tolerance (relative 1e-5, absolute 1e-8).
+
+
+def mangle(text, rand):
+    """ Drop or replace a character, to make the queries a bit fuzzy """
+    if len(text) < 4:
+        return text
+    i = rand.randrange(len(text))
+    if rand.random() < .5:
+        return text[:i] + text[i + 1:]
+    return text[:i] + "x" + text[i + 1:]
+
+
+def sample_artists(rand):
+    """ Pick up to ARTISTS_PER_BUCKET artist credits for each size bucket """
+    cur = db.execute_sql("""SELECT artist_credit_id, count(DISTINCT recording_name) AS cnt
+                              FROM mapping
+                          GROUP BY artist_credit_id""")
+    buckets = defaultdict(list)
+    for artist_credit_id, count in cur.fetchall():
+        for bucket in SIZE_BUCKETS:
+            if count <= bucket:
+                buckets[bucket].append(artist_credit_id)
+                break
+
+    return { bucket: rand.sample(ids, min(len(ids), ARTISTS_PER_BUCKET)) for bucket, ids in buckets.items() }
+
+
+def recording_names(artist_credit_id):
+    cur = db.execute_sql("SELECT DISTINCT recording_name FROM mapping WHERE artist_credit_id = ?", (artist_credit_id,))
+    encoded = [ FuzzyIndex.encode_string(row[0]) for row in cur.fetchall() ]
+    return [ { "text": text, "id": i } for i, text in enumerate([ e for e in encoded if e ]) ]
+
+
+def bench_backend(backend, arrays, queries):
+    """ Return load time, total search time and the search results for one backend """
+    t0 = monotonic()
+    index = FuzzyIndex(backend=backend)
+    index.load_from_arrays(arrays)
+    t1 = monotonic()
+    results = [ index.search(query, min_confidence=MIN_CONFIDENCE) for query in queries ]
+    t2 = monotonic()
+
+    return t1 - t0, t2 - t1, results
+
+
+def benchmark(index_dir):
+    rand = Random(42)
+    open_db(os.path.join(index_dir, "mapping.db"))
+
+    table = []
+    for bucket, artist_ids in sorted(sample_artists(rand).items()):
+        times = { BACKEND_NMSLIB: [0.0, 0.0], BACKEND_NUMPY: [0.0, 0.0] }
+        num_queries = 0
+        mismatches = 0
+        for artist_credit_id in artist_ids:
+            index_data = recording_names(artist_credit_id)
+            if not index_data:
+                continue
+            fitted = FuzzyIndex()
+            fitted.fit(index_data, "text")
+            arrays = fitted.to_arrays()
+            queries = [ mangle(rand.choice(index_data)["text"], rand) for i in range(QUERIES_PER_ARTIST) ]
+            num_queries += len(queries)
+
+            results = {}
+            for backend in times:
+                load_time, search_time, results[backend] = bench_backend(backend, arrays, queries)
+                times[backend][0] += load_time
+                times[backend][1] += search_time
+
+            for a, b in zip(results[BACKEND_NMSLIB], results[BACKEND_NUMPY]):
+                # nmslib returns documents with the same confidence in any order
+                if sorted([ r["id"] for r in a ]) != sorted([ r["id"] for r in b ]) or \
+                   not np.allclose([ r["confidence"] for r in a ], [ r["confidence"] for r in b ]):
+                    mismatches += 1
+
+        if not num_queries:
+            continue
+        num_artists = len(artist_ids)
+        table.append([ "<= %d" % bucket, num_artists,
+                       "%.3fms" % (times[BACKEND_NMSLIB][0] * 1000 / num_artists),
+                       "%.3fms" % (times[BACKEND_NUMPY][0] * 1000 / num_artists),
+                       "%.3fms" % (times[BACKEND_NMSLIB][1] * 1000 / num_queries),
+                       "%.3fms" % (times[BACKEND_NUMPY][1] * 1000 / num_queries),
+                       mismatches ])
+
+    print(tabulate(table, headers=[ "recordings", "artists", "nmslib load", "numpy load",
+                                    "nmslib search", "numpy search", "mismatches" ]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: bench_fuzzy_index.py <index dir>")
+        sys.exit(-1)
+
+    benchmark(sys.argv[1])
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+from collections import defaultdict
+from random import Random
+from time import monotonic
+from uuid import UUID
+import json
+import os
+import resource
+import sys
+import threading
+
+import numpy as np
+from tabulate import tabulate
+from werkzeug.exceptions import NotFound
+
+from bench_fuzzy_index import mangle
+from artist_resolution_cache import ArtistResolutionCache
+from build_indexes import BuildIndexes
+from database import create_db, db
+from global_index import GlobalIndex, build_global_index
+from mapping_index import MappingLookupIndex, create_mapping_indexes, INSERT_MAPPING, TEMP_DIR
+from mapping_lookup import MappingLookup
+from search_index import MappingLookupSearch
+from shared_mem_cache import SharedMemoryArtistDataCache
+from stage_timer import StageTimer
+
+# Offline benchmark of the whole search path: artist search, artist loading, recording/release search and the
+# final mapping.db fetch. "generate" writes a synthetic mapping.db with the indexes the server uses and a query
+# file, "run" replays a query file (one {"artist", "release", "recording"} JSON object per line, like the
+# load test's) and prints the latency of each stage.
+
+NUM_ARTISTS = 10000
+# Artist sizes follow a power law: most artists have a handful of recordings, a few have many thousands
+ARTIST_SIZE_SHAPE = 1.2
+MAX_ARTIST_SIZE = 20000
+RECORDINGS_PER_RELEASE = 12
+QUERIES_PER_ARTIST = 2
+# Share of the queries that have no release, and of those that ask for an artist that does not exist
+NO_RELEASE_QUERIES = .3
+UNKNOWN_ARTIST_QUERIES = .05
+
+WORDS = ("love", "night", "blue", "fire", "dream", "river", "song", "heart", "city", "light", "rain", "gold",
+         "shadow", "summer", "wild", "dance", "star", "road", "ghost", "silver", "ocean", "black", "paper", "moon",
+         "velvet", "echo", "storm", "garden", "machine", "winter", "stone", "glass", "sun", "radio", "forever")
+STUPID_NAMES = ("!!!", "?!", "...", "***", "+/-", "#####", "<>", "!@#$")
+
+CACHE_SIZE = 1024 * 1024 * 1024
+LOCAL_CACHE_SIZE = 1024 * 1024 * 128
+FAN_OUT = 4
+
+PERCENTILES = (50, 90, 99)
+STAGE_TOTAL = "total"
+
+
+class RecordingStageTimer(StageTimer):
+    """ Keep every observed stage time, for percentiles, and the counters """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = defaultdict(list)
+        self.counts = defaultdict(int)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.times[stage].append(seconds)
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counts[counter] += n
+
+    def reset(self):
+        with self.lock:
+            self.times = defaultdict(list)
+            self.counts = defaultdict(int)
+
+
+def make_name(rand, num_words):
+    return " ".join([ rand.choice(WORDS) for i in range(num_words) ]).title()
+
+
+def make_mbid(rand):
+    return str(UUID(int=rand.getrandbits(128), version=4))
+
+
+def artist_rows(rand, artist_credit_id, artist_name, release_id, recording_id):
+    """ Return the mapping rows of one synthetic artist, with releases and recordings numbered from the given ids """
+
+    artist_mbids = make_mbid(rand)
+    num_recordings = min(int(rand.paretovariate(ARTIST_SIZE_SHAPE) * 5), MAX_ARTIST_SIZE)
+    num_releases = num_recordings // RECORDINGS_PER_RELEASE + 1
+    releases = [ (release_id + i, make_mbid(rand), make_name(rand, rand.randint(1, 3))) for i in range(num_releases) ]
+
+    rows = []
+    for i in range(num_recordings):
+        recording = (recording_id + i, make_mbid(rand), make_name(rand, rand.randint(1, 4)))
+        # Some recordings are on more than one release
+        for release in rand.sample(releases, min(len(releases), rand.choice((1, 1, 1, 2, 3)))):
+            rows.append((artist_credit_id, artist_mbids, artist_name, artist_name) + release + recording + (0,))
+
+    return rows, num_releases, num_recordings
+
+
+def generate(index_dir, num_artists, num_procs):
+    """ Write a synthetic mapping.db, build the artist indexes and the artist store and write queries.jsonl """
+
+    rand = Random(42)
+    os.makedirs(index_dir, exist_ok=True)
+    create_db(os.path.join(index_dir, "mapping.db"))
+    db.execute_sql("PRAGMA journal_mode = OFF")
+    db.execute_sql("PRAGMA synchronous = OFF")
+
+    print("Generate %d artists" % num_artists)
+    mi = MappingLookupIndex()
+    queries = []
+    release_id = 1
+    recording_id = 1
+    num_rows = 0
+    db.execute_sql("BEGIN")
+    for artist_credit_id in range(1, num_artists + 1):
+        if rand.random() < .01:
+            artist_name = rand.choice(STUPID_NAMES)
+        else:
+            artist_name = make_name(rand, rand.randint(1, 3))
+        rows, num_releases, num_recordings = artist_rows(rand, artist_credit_id, artist_name, release_id, recording_id)
+        release_id += num_releases
+        recording_id += num_recordings
+        num_rows += len(rows)
+        # Lower scores are preferred, number the rows in the order they were generated
+        rows = [ row[:-1] + (score,) for score, row in enumerate(rows) ]
+        db.cursor().executemany(INSERT_MAPPING, rows)
+        mi.add_artist(artist_credit_id, artist_name, artist_name)
+
+        for row in rand.sample(rows, min(len(rows), QUERIES_PER_ARTIST)):
+            release = "" if rand.random() < NO_RELEASE_QUERIES else mangle(row[6], rand)
+            queries.append({ "artist": mangle(row[2], rand), "release": release, "recording": mangle(row[9], rand) })
+    db.execute_sql("COMMIT")
+    print("Generated %d rows" % num_rows)
+
+    for i in range(int(len(queries) * UNKNOWN_ARTIST_QUERIES)):
+        queries.append({ "artist": "Unknown Artist %d" % i, "release": "", "recording": make_name(rand, 2) })
+    rand.shuffle(queries)
+
+    create_mapping_indexes()
+    db.close()
+    mi.save_artist_indexes(index_dir)
+
+    print("Build artist store")
+    BuildIndexes(index_dir, TEMP_DIR, num_procs).build()
+
+    print("Build global index")
+    build_global_index(index_dir)
+    db.close()
+
+    with open(os.path.join(index_dir, "queries.jsonl"), "w") as f:
+        for query in queries:
+            f.write(json.dumps(query) + "\n")
+    print("Wrote %d queries" % len(queries))
+
+
+def load_queries(queries_file):
+    queries = []
+    with open(queries_file, "r") as f:
+        for line in f:
+            if line.strip():
+                query = json.loads(line)
+                queries.append((query["artist"], query.get("release", ""), query["recording"]))
+
+    return queries
+
+
+def replay(lookup, queries, batch_size, timer):
+    """ Search all queries, one at a time or in batches. Returns the number of queries that had a hit """
+
+    hits = 0
+    if batch_size == 1:
+        for artist, release, recording in queries:
+            try:
+                with timer.time(STAGE_TOTAL):
+                    results = lookup.mapping_search(artist, release, recording)
+                if results:
+                    hits += 1
+            except NotFound:
+                pass
+        return hits
+
+    for i in range(0, len(queries), batch_size):
+        batch = queries[i:i + batch_size]
+        t0 = monotonic()
+        results = lookup.mapping_search_batch(batch)
+        # Each query of a batch waited for the whole batch
+        duration = monotonic() - t0
+        for result in results:
+            timer.observe(STAGE_TOTAL, duration)
+            if result:
+                hits += 1
+
+    return hits
+
+
+def report(timer, num_queries, hits, duration):
+    table = []
+    for stage, times in sorted(timer.times.items()):
+        times = np.array(times) * 1000
+        table.append([ stage, len(times), "%.3f" % times.sum(), "%.3f" % times.mean() ]
+                     + [ "%.3f" % p for p in np.percentile(times, PERCENTILES) ]
+                     + [ "%.3f" % times.max() ])
+
+    print(tabulate(table, headers=[ "stage", "count", "total ms", "mean ms" ]
+                                  + [ "p%d ms" % p for p in PERCENTILES ] + [ "max ms" ]))
+    for counter, count in sorted(timer.counts.items()):
+        print("%s: %d" % (counter, count))
+    print("%d queries, %d hits in %.2fs: %.1f queries/s" % (num_queries, hits, duration, num_queries / duration))
+
+
+def run(index_dir, queries_file, batch_size, passes, use_global_index):
+    """ Replay the queries passes times, against cold caches first. Print the stage times of each pass. """
+
+    queries = load_queries(queries_file)
+    global_index = GlobalIndex.open(index_dir) if use_global_index else None
+    if use_global_index and global_index is None:
+        print("%s has no global index" % index_dir)
+        sys.exit(-1)
+
+    timer = RecordingStageTimer()
+    cache = SharedMemoryArtistDataCache(TEMP_DIR, max_cache_size=CACHE_SIZE)
+    cache.clear_cache()
+    ms = MappingLookupSearch(cache, index_dir, global_index=global_index, local_cache_size=LOCAL_CACHE_SIZE,
+                             fan_out=FAN_OUT, timer=timer)
+    resolution_cache = ArtistResolutionCache()
+    resolution_cache.clear()
+    lookup = MappingLookup(index_dir, ms, timer=timer, resolution_cache=resolution_cache)
+
+    try:
+        for i in range(passes):
+            timer.reset()
+            t0 = monotonic()
+            hits = replay(lookup, queries, batch_size, timer)
+            duration = monotonic() - t0
+            print("\npass %d" % (i + 1))
+            report(timer, len(queries), hits, duration)
+
+        stats = cache.stats()
+        print("\nshared cache: %d hits, %d misses, %d evictions, %d entries, %.1fMB" %
+              (stats["hits"], stats["misses"], stats["evictions"], stats["entries"], stats["bytes"] / 1024 / 1024))
+        if ms.local_cache is not None:
+            print("local cache: %d hits, %d misses, %.1fMB" %
+                  (ms.local_cache.hits, ms.local_cache.misses, ms.local_cache.size / 1024 / 1024))
+        print("max RSS: %.1fMB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    finally:
+        cache.clear_cache()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "generate":
+        num_artists = int(sys.argv[3]) if len(sys.argv) > 3 else NUM_ARTISTS
+        num_procs = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+        generate(sys.argv[2], num_artists, num_procs)
+    elif len(sys.argv) >= 4 and sys.argv[1] == "run":
+        args = sys.argv[4:]
+        batch_size = 1
+        passes = 2
+        use_global_index = False
+        while args:
+            arg = args.pop(0)
+            if arg == "--batch" and args:
+                batch_size = int(args.pop(0))
+            elif arg == "--passes" and args:
+                passes = int(args.pop(0))
+            elif arg == "--global":
+                use_global_index = True
+            else:
+                print("Unknown option %s" % arg)
+                sys.exit(-1)
+        run(sys.argv[2], sys.argv[3], batch_size, passes, use_global_index)
+    else:
+        print("Usage: bench_search.py generate <index dir> [num artists] [num procs]")
+        print("       bench_search.py run <index dir> <queries file> [--batch <size>] [--passes <n>] [--global]")
+        sys.exit(-1)
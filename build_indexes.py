@@ -1,27 +1,57 @@
 #!/usr/bin/env python3
 
 import concurrent.futures
-from time import monotonic
 import os
 import sys
-from time import sleep
 from traceback import print_exception
 
-from peewee import *
 from tqdm import tqdm
 
-from fuzzy_index import FuzzyIndex
-from database import Mapping, IndexCache, open_db, db
+from artist_store import ArtistStoreWriter, STORE_FILE
+from database import open_db, db
 from search_index import MappingLookupSearch
 from shared_mem_cache import SharedMemoryArtistDataCache
 
+# The most artists in one batch, to keep the results a worker sends back at once small
 BATCH_SIZE = 500
+# Aim for this many batches per worker, so that workers that finish early can pick up more work
+BATCHES_PER_PROC = 20
 
 bi = None
 
+def init_worker(index_dir, temp_dir):
+    """
+        Each worker reads the database through its own read-only connections. Workers only build artist data
+        and send it back, the parent process owns the single ArtistStoreWriter and writes all of it to the store.
+    """
+    global bi
+    bi = BuildIndexes(index_dir, temp_dir)
+
 def build_data(lst):
-    bi.build_artist_data_index(lst)
-        
+    return bi.build_artist_data_index(lst)
+
+def cost_batches(artists, num_batches):
+    """
+        Split a list of (artist_credit_id, cost) sorted by decreasing cost into batches of artist_credit_ids
+        of about the same total cost. The most expensive artists come first, each in a batch of their own
+        if they cost more than a batch should.
+    """
+    target = sum([ cost for artist_credit_id, cost in artists ]) / max(num_batches, 1)
+    batches = []
+    batch = []
+    batch_cost = 0
+    for artist_credit_id, cost in artists:
+        batch.append(artist_credit_id)
+        batch_cost += cost
+        if batch_cost >= target or len(batch) >= BATCH_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_cost = 0
+    if batch:
+        batches.append(batch)
+
+    return batches
+
 class BuildIndexes:
     
     def __init__(self, index_dir, temp_dir, num_procs=1):
@@ -32,75 +62,39 @@ class BuildIndexes:
         self.ms = MappingLookupSearch(self.cache, index_dir)
 
     def build_artist_data_index(self, artist_list):
-        batch = []
-        for artist_credit_id in artist_list:
-            data = self.ms.load_artist(artist_credit_id, write_cache=False)
-            try:
-                pickled = self.cache.pickle_data(data)
-            except TypeError:
-                pickled = None
-            
-            batch.append((artist_credit_id, pickled))
-            if len(batch) >= BATCH_SIZE:
-                with db.atomic() as transaction:
-                    for ac_id, pickled in batch:
-                        while True:
-                            try:
-                                index = IndexCache().create(artist_credit_id=ac_id, artist_data=pickled)
-                                index.replace()
-                                break
-                            except OperationalError:
-                                sleep(.1)
-                            
-                batch = []
+        """ Build the data of a list of artists, returns a list of (artist_credit_id, packed data) """
+        return [ (artist_credit_id, self.ms.create_artist(artist_credit_id).buffer) for artist_credit_id in artist_list ]
 
-        if batch:
-            with db.atomic() as transaction:
-                for ac_id, pickled in batch:
-                    while True:
-                        try:
-                            index = IndexCache().create(artist_credit_id=ac_id, artist_data=pickled)
-                            index.replace()
-                            break
-                        except OperationalError:
-                            sleep(.1)
-            batch = []
-            
-    def build_data(self, lst):
-        for l in lst:
-            build_artist_data_index(l)
-            
     def build(self):
-        cur = db.execute_sql("""WITH artist_ids AS (
-                                        SELECT DISTINCT mapping.artist_credit_id
-                                          FROM mapping
-                                     LEFT JOIN index_cache
-                                            ON mapping.artist_credit_id = index_cache.artist_credit_id
-                                         WHERE index_cache.artist_credit_id is null
-                                )
-                                        SELECT artist_credit_id, count(*) as cnt
-                                          FROM artist_ids
-                                      GROUP BY artist_credit_id order by cnt desc""")
-
-        proc_data = []
-        cur_chunk = []
-        for row in enumerate(cur.fetchall()):
-            cur_chunk.append(row[0])
-            if len(cur_chunk) >= BATCH_SIZE:
-                proc_data.append(cur_chunk)
-                cur_chunk = []
-        if cur_chunk:
-            proc_data.append(cur_chunk)
+        """
+            Build all artists on num_procs worker processes. The artists are split into batches by their
+            number of mapping rows and queued largest first, idle workers take the next batch. The workers
+            send the built data back to this process, which is the only one writing the store.
+        """
+        open_db(os.path.join(self.index_dir, "mapping.db"))
+        cur = db.execute_sql("""SELECT artist_credit_id, count(*) as cnt
+                                  FROM mapping
+                              GROUP BY artist_credit_id order by cnt desc""")
+        proc_data = cost_batches(cur.fetchall(), self.num_procs * BATCHES_PER_PROC)
+        # Don't share this connection with the workers
+        db.close()
 
+        writer = ArtistStoreWriter(os.path.join(self.index_dir, STORE_FILE))
         with tqdm(total=len(proc_data)) as t:
-            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_procs) as exe:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_procs, initializer=init_worker,
+                                                        initargs=(self.index_dir, self.temp_dir)) as exe:
                 future_to_batch = {exe.submit(build_data, data): i for i, data in enumerate(proc_data) }
                 for future in concurrent.futures.as_completed(future_to_batch):
                     exc = future.exception()
                     if exc:
                         print_exception(exc)
                         sys.exit(-1)
+                    for artist_credit_id, data in future.result():
+                        writer.add(artist_credit_id, data)
+                    # Let go of the results once they are written
+                    del future_to_batch[future]
                     t.update(1)
+        writer.close()
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
@@ -109,7 +103,6 @@ if __name__ == "__main__":
 
     index_dir = sys.argv[1]
     num_procs = sys.argv[2]
-    open_db(os.path.join(index_dir, "mapping.db"))
     bi = BuildIndexes(index_dir, "/mnt/tmpfs", int(num_procs))
 #    bi.ms.load_artist(65)
     bi.build()
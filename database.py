@@ -1,6 +1,12 @@
 import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
 from peewee import *
 
+from stage_timer import StageTimer, COUNTER_SQLITE_CONNECTIONS
+
 PRAGMAS = (
     ('foreign_keys', 1),
 #    ('journal_mode', 'WAL'),
@@ -8,6 +14,37 @@ PRAGMAS = (
 
 db = SqliteDatabase(None, pragmas=PRAGMAS)
 
+# The response fields of the mapping rows, keyed by (release_id, recording_id) and in mapping order for each
+# key (mapping_row is the row's rowid in mapping). Built by mapping_index.py after mapping is loaded. Without a
+# rowid the table is its own primary key index, so fetching a search hit's rows is a single range read.
+CREATE_RESULT_TABLE = """CREATE TABLE mapping_result (release_id INTEGER NOT NULL,
+                                                     recording_id INTEGER NOT NULL,
+                                                     mapping_row INTEGER NOT NULL,
+                                                     artist_credit_id INTEGER NOT NULL,
+                                                     artist_mbids TEXT NOT NULL,
+                                                     artist_credit_name TEXT NOT NULL,
+                                                     artist_credit_sortname TEXT,
+                                                     release_mbid TEXT NOT NULL,
+                                                     release_name TEXT,
+                                                     recording_mbid TEXT NOT NULL,
+                                                     recording_name TEXT,
+                                                     shard_ch TEXT,
+                                                     PRIMARY KEY (release_id, recording_id, mapping_row)) WITHOUT ROWID"""
+RESULT_COLUMNS = """artist_credit_id, artist_mbids, artist_credit_name, artist_credit_sortname,
+                    release_mbid, release_name, recording_mbid, recording_name, shard_ch"""
+RESULT_FIELDS = tuple([ column.strip() for column in RESULT_COLUMNS.split(",") ])
+
+# Pragmas of the read-only connections of the search path. The database is mapped rather than read into
+# each connection's page cache, so the mapped pages are shared by all processes.
+READ_ONLY_PRAGMAS = (
+    ('query_only', 1),
+    ('mmap_size', 1024 * 1024 * 1024 * 4),
+    ('cache_size', -1024 * 4),
+    ('temp_store', 'MEMORY'),
+)
+# How long a read waits for a writer (mapping_index.py refresh) to finish, in seconds
+READ_ONLY_TIMEOUT = 10
+
 class Mapping(Model):
 
     class Meta:
@@ -29,16 +66,7 @@ class Mapping(Model):
     recording_name = TextField()
 
     score = IntegerField(null=False)
-    shard_ch = FixedCharField(null=False)
-
-class IndexCache(Model):
-    class Meta:
-        database = db
-        table_name = "index_cache"
-        primary_key = False
-
-    artist_credit_id = IntegerField(null=False, index=True)
-    artist_data = BlobField(null=False)
+    shard_ch = FixedCharField(null=True)
 
 def create_db(db_file):
     try:
@@ -48,8 +76,67 @@ def create_db(db_file):
 
     db.init(db_file)
     db.connect()
-    db.create_tables((Mapping,IndexCache))
+    db.create_tables((Mapping,))
 
 def open_db(db_file):
     db.init(db_file)
     db.connect()
+
+
+class ReadOnlyMappingDB:
+    """
+        Read-only connections to a mapping.db for the search path. Each thread opens its own connection on
+        first use and keeps it, so searches don't connect or set up a connection per request. The queries
+        are fixed strings, which sqlite3 keeps prepared in each connection's statement cache. A connection
+        is opened again once create_db() has replaced the file it reads.
+    """
+
+    ARTIST_ROWS = """SELECT recording_id, recording_name, release_id, release_name, score
+                       FROM mapping
+                      WHERE artist_credit_id = ?"""
+    MAPPING_ROWS = "SELECT " + RESULT_COLUMNS + " FROM {table} WHERE release_id = ? AND recording_id = ?"
+
+    def __init__(self, db_file, timer=None):
+        self.db_file = db_file
+        self.timer = timer or StageTimer()
+        self.local = threading.local()
+
+    def connection(self):
+        """ Return this thread's connection, opening it first if needed """
+        conn = getattr(self.local, "conn", None)
+        # Connections can't be used across a fork, a forked process opens its own
+        if conn is not None and self.local.pid == os.getpid():
+            if not self.replaced():
+                return conn
+            conn.close()
+
+        # stat before connecting: if the file is replaced while connecting, the next call notices it
+        self.local.stat = os.stat(self.db_file)
+        conn = sqlite3.connect("file:%s?mode=ro" % quote(os.path.abspath(self.db_file)), uri=True,
+                               timeout=READ_ONLY_TIMEOUT, check_same_thread=False)
+        for name, value in READ_ONLY_PRAGMAS:
+            conn.execute("PRAGMA %s = %s" % (name, value))
+        # Databases built before mapping_result existed are read from mapping
+        has_results = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'mapping_result'").fetchone()
+        self.local.mapping_rows = self.MAPPING_ROWS.format(table="mapping_result" if has_results else "mapping")
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        self.timer.count(COUNTER_SQLITE_CONNECTIONS)
+        return conn
+
+    def replaced(self):
+        """ Return True if the database file has been replaced since this thread connected to it """
+        try:
+            stat = os.stat(self.db_file)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_dev) != (self.local.stat.st_ino, self.local.stat.st_dev)
+
+    def artist_rows(self, artist_credit_id):
+        """ Return the (recording_id, recording_name, release_id, release_name, score) rows of an artist credit """
+        return self.connection().execute(self.ARTIST_ROWS, (artist_credit_id,)).fetchall()
+
+    def mapping_rows(self, release_id, recording_id):
+        """ Return the mapping rows of a release and recording as dicts, without their ids and score """
+        conn = self.connection()
+        return [ dict(zip(RESULT_FIELDS, row)) for row in conn.execute(self.local.mapping_rows, (release_id, recording_id)) ]
@@ -1,19 +1,48 @@
 import os
+from hashlib import blake2b
 from math import fabs
 from time import monotonic
 import pickle
 import re
+import shutil
 import sys
 
-import sklearn
-from sklearn.feature_extraction.text import TfidfVectorizer
-
-import nmslib
+import numpy as np
+from scipy.sparse import csr_matrix
 from unidecode import unidecode
-from utils import ngrams
+from trigram_vectorizer import TrigramVectorizer, trigram_code, trigram_codes
+from utils import ngrams, pack_strings, replace_dir, take_strings, unpack_string
+
+# scikit-learn and nmslib are imported where they are needed: indexes that are loaded with load_arrays() and
+# use the TrigramVectorizer need neither, so neither do the server and tools that only encode strings.
 
 MAX_ENCODED_STRING_LENGTH = 30
 NUM_FUZZY_SEARCH_RESULTS = 500
+# search_arrays() starts with this many neighbours and asks for SEARCH_WIDEN_FACTOR times more (up to
+# NUM_FUZZY_SEARCH_RESULTS) for queries whose last neighbour would still be returned
+SEARCH_MIN_K = 16
+SEARCH_WIDEN_FACTOR = 4
+NMSLIB_THREADS = 5
+# Indexes with up to this many documents are searched with a sparse matrix-vector product instead of nmslib
+SPARSE_BACKEND_THRESHOLD = 20000
+
+BACKEND_NMSLIB = "nmslib"
+BACKEND_NUMPY = "numpy"
+# The index is the transposed (term x document) tf-idf matrix, so a search only reads the posting lists of the
+# query's trigrams. This is how indexes loaded with load_arrays() are searched.
+BACKEND_INVERTED = "inverted"
+
+# save() also writes the index as .npy files into this directory of the index dir, for load_arrays()
+ARRAYS_DIR = "%s_arrays"
+ARRAY_NAMES = ("vocab", "idf", "ids", "text_offsets", "text", "postings_indptr", "postings_docs", "postings_weights",
+               "exact_hashes", "exact_order")
+
+# Everything encode_string() removes: punctuation, spaces and underscores
+ENCODE_REMOVE = re.compile(r"[\W_]+")
+# encode_string() for ASCII characters as one str.translate() table: remove non-word characters, lower case.
+# NUL is kept, it separates the strings in encode_strings().
+ENCODE_ASCII_TABLE = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz",
+                                   "".join([ c for c in map(chr, range(1, 128)) if not c.isalnum() ]))
 
 class FuzzyIndex:
     '''
@@ -21,11 +50,31 @@ class FuzzyIndex:
        algorithm.
     '''
 
-    def __init__(self, name=None):
-        self.index_data = None
+    def __init__(self, name=None, backend=None, hashed_vocabulary=True):
+        """
+            backend selects how the index is searched: BACKEND_NMSLIB, BACKEND_NUMPY, BACKEND_INVERTED or None
+            to pick numpy for indexes of up to SPARSE_BACKEND_THRESHOLD documents and nmslib for larger ones.
+            With hashed_vocabulary the vocabulary is kept as an array of trigram codes by a
+            TrigramVectorizer, otherwise scikit-learn's TfidfVectorizer and its dict of terms is used.
+            Both compute the same features.
+        """
+        if backend not in (None, BACKEND_NMSLIB, BACKEND_NUMPY, BACKEND_INVERTED):
+            raise ValueError("Unknown fuzzy index backend '%s'" % backend)
         self.name = name
-        self.index = nmslib.init(method='simple_invindx', space='negdotprod_sparse_fast', data_type=nmslib.DataType.SPARSE_VECTOR)
-        self.vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
+        self.backend = backend
+        self.matrix = None
+        self.texts = None
+        self.ids = None
+        self.index = None
+        self.exact_hashes = None
+        self.exact_order = None
+        # os.stat() of the saved index this index was loaded from
+        self.stat = None
+        if hashed_vocabulary:
+            self.vectorizer = TrigramVectorizer()
+        else:
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            self.vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
 
     @staticmethod
     def encode_string(text):
@@ -33,7 +82,21 @@ class FuzzyIndex:
         #TODO: sometimes there are trailing spaces: 'Ji He Xue Mo Yang ' 
         if text is None:
             return None
-        return unidecode(re.sub("[ _]+", "", re.sub(r'[^\w ]+', '', text)).strip().lower())[:MAX_ENCODED_STRING_LENGTH]
+        return unidecode(ENCODE_REMOVE.sub("", text).lower())[:MAX_ENCODED_STRING_LENGTH]
+
+    @staticmethod
+    def encode_strings(texts):
+        """
+            encode_string() for a list of strings. The strings are joined and normalized with a single
+            translate() call; only strings with non-ASCII characters need a regex and unidecode.
+        """
+        if any(text is not None and "\x00" in text for text in texts):
+            return [ FuzzyIndex.encode_string(text) for text in texts ]
+
+        joined = "\x00".join([ text for text in texts if text is not None ]).translate(ENCODE_ASCII_TABLE)
+        encoded = iter([ (e if e.isascii() else unidecode(ENCODE_REMOVE.sub("", e).lower()))[:MAX_ENCODED_STRING_LENGTH]
+                         for e in joined.split("\x00") ])
+        return [ None if text is None else next(encoded) for text in texts ]
 
     @staticmethod
     def encode_string_for_stupid_artists(text):
@@ -42,14 +105,165 @@ class FuzzyIndex:
             return None
         return unidecode(re.sub("[ _]+", "", text).strip())[:MAX_ENCODED_STRING_LENGTH]
 
-    def build(self, index_data, field):
+    def fit(self, index_data, field):
+        """ Fit the vectorizer and compute the tf-idf matrix, without creating the nmslib index. """
         if not index_data:
             raise ValueError("No index data passed to index build().")
-        self.index_data = index_data
         strings = [x[field] for x in index_data]
-        lookup_matrix = self.vectorizer.fit_transform(strings)
-        self.index.addDataPointBatch(lookup_matrix, list(range(len(strings))))
-        self.index.createIndex()
+        self.set_documents(np.fromiter((x["id"] for x in index_data), dtype=np.int64, count=len(index_data)), strings)
+        self.matrix = self.vectorizer.fit_transform(strings)
+
+    def fit_strings(self, strings):
+        """ fit() for a list of strings, their ids are their positions in the list. """
+        if not strings:
+            raise ValueError("No index data passed to index build().")
+        self.set_documents(np.arange(len(strings), dtype=np.int64), strings)
+        self.matrix = self.vectorizer.fit_transform(strings)
+
+    def set_documents(self, ids, strings):
+        """
+            Keep the document ids and texts as read-only arrays. Searches never change the index, so any
+            number of threads can search it at the same time.
+        """
+        self.ids = ids
+        self.texts = pack_strings(strings)
+        for array in (self.ids, *self.texts):
+            array.flags.writeable = False
+
+    def documents(self):
+        """ Return the documents as a list of new { "id", "text" } dicts, as they were passed to fit() """
+        return [ { "id": int(self.ids[i]), "text": self.text(i) } for i in range(len(self.ids)) ]
+
+    def build(self, index_data, field):
+        self.fit(index_data, field)
+        self.create_index()
+
+    def update(self, remove_ids, index_data, field):
+        """
+            Remove the documents with the given ids and add the documents of index_data, without vectorizing
+            the documents that stay again. Their weights are recomputed from the stored ones for the new
+            vocabulary and idf, so the result is the index that fit() computes for all documents in id order,
+            up to rounding. Works on fitted indexes and on indexes loaded with load_arrays(), afterwards the
+            index is searched with BACKEND_INVERTED.
+        """
+        if not isinstance(self.vectorizer, TrigramVectorizer):
+            raise ValueError("Only indexes with a hashed vocabulary can be updated")
+
+        # The term counts of the current documents, up to a factor per document that normalizing removes
+        matrix = (self.matrix if self.matrix is not None else self.index.T).tocoo()
+        idf = np.asarray(self.vectorizer.idf)
+        num_docs = len(self.ids)
+        strings = [ x[field] for x in index_data ]
+        new_rows, new_codes = trigram_codes(strings)
+        rows = np.concatenate((matrix.row, new_rows + num_docs))
+        codes = np.concatenate((np.asarray(self.vectorizer.vocabulary)[matrix.col], new_codes))
+        counts = np.concatenate((matrix.data.astype(np.float64) / idf[matrix.col], np.ones(len(new_codes))))
+        ids = np.concatenate((self.ids, np.fromiter((x["id"] for x in index_data), dtype=np.int64, count=len(index_data))))
+
+        # The documents that stay and the new ones, in id order like a full build
+        keep = ~np.isin(ids, np.asarray(remove_ids, dtype=np.int64))
+        keep[num_docs:] = True
+        docs = np.flatnonzero(keep)
+        docs = docs[np.argsort(ids[docs], kind="stable")]
+        if len(docs) == 0:
+            raise ValueError("No index data left after update().")
+
+        # Drop the terms that only removed documents had, then compute idf and weights like TrigramVectorizer
+        vocabulary, cols = np.unique(codes, return_inverse=True)
+        matrix = csr_matrix((counts, (rows, cols.ravel())), shape=(len(ids), len(vocabulary)))[docs]
+        df = np.bincount(matrix.indices, minlength=len(vocabulary))
+        used = df > 0
+        columns = np.cumsum(used) - 1
+        vocabulary, df = vocabulary[used], df[used]
+        idf = np.log((1 + len(docs)) / (1 + df)) + 1
+        cols = columns[matrix.indices]
+        doc_rows = np.repeat(np.arange(len(docs)), np.diff(matrix.indptr))
+        weights = matrix.data * idf[cols]
+        weights /= np.sqrt(np.bincount(doc_rows, weights=weights * weights, minlength=len(docs)))[doc_rows]
+        self.matrix = csr_matrix((weights, cols.astype(np.int32), matrix.indptr.astype(np.int32)),
+                                 shape=(len(docs), len(vocabulary)))
+        self.vectorizer = TrigramVectorizer(vocabulary, idf)
+
+        offsets, text = self.texts
+        new_offsets, new_text = pack_strings(strings)
+        if self.exact_hashes is not None:
+            hashes = np.empty(num_docs, dtype=np.int64)
+            hashes[self.exact_order] = self.exact_hashes
+            hashes = np.concatenate((hashes, np.array([ text_hash(s) for s in strings ], dtype=np.int64)))[docs]
+            self.exact_order = np.argsort(hashes, kind="stable")
+            self.exact_hashes = hashes[self.exact_order]
+        self.ids = ids[docs]
+        self.texts = take_strings(np.concatenate((offsets, new_offsets[1:] + offsets[-1])),
+                                  np.concatenate((text, new_text)), docs)
+        for array in (self.ids, *self.texts):
+            array.flags.writeable = False
+
+        self.backend = BACKEND_INVERTED
+        self.create_index()
+
+    def create_index(self):
+        """ Make the fitted matrix searchable with the configured backend """
+        if self.backend is None:
+            self.backend = BACKEND_NUMPY if self.matrix.shape[0] <= SPARSE_BACKEND_THRESHOLD else BACKEND_NMSLIB
+
+        # Searched in single precision like nmslib, see knn_query_batch()
+        if self.backend == BACKEND_NUMPY:
+            # The matrix is the index
+            self.index = self.matrix.astype(np.float32, copy=False)
+            return
+
+        if self.backend == BACKEND_INVERTED:
+            self.index = self.matrix.T.tocsr().astype(np.float32, copy=False)
+            return
+
+        self.index = self.create_nmslib_index()
+
+    def create_nmslib_index(self):
+        import nmslib
+        index = nmslib.init(method='simple_invindx', space='negdotprod_sparse_fast', data_type=nmslib.DataType.SPARSE_VECTOR)
+        index.addDataPointBatch(self.matrix, list(range(self.matrix.shape[0])))
+        index.createIndex()
+        return index
+
+    def to_arrays(self):
+        """ Return the fitted index as a dict of flat numpy arrays, suitable for packing into a buffer. """
+        if self.matrix is None:
+            raise IndexError("Must fit index before exporting it")
+
+        if isinstance(self.vectorizer, TrigramVectorizer):
+            vocabulary, idf = self.vectorizer.vocabulary, self.vectorizer.idf
+        else:
+            vocabulary = np.empty(len(self.vectorizer.vocabulary_), dtype=np.int64)
+            for term, col in self.vectorizer.vocabulary_.items():
+                vocabulary[col] = trigram_code(term)
+            idf = self.vectorizer.idf_
+        text_offsets, text = self.texts
+
+        return { "vocab": vocabulary,
+                 "idf": idf.astype(np.float64),
+                 "indptr": self.matrix.indptr.astype(np.int64),
+                 "indices": self.matrix.indices.astype(np.int32),
+                 "data": self.matrix.data.astype(np.float32),
+                 "ids": self.ids,
+                 "text_offsets": text_offsets,
+                 "text": text }
+
+    def load_from_arrays(self, arrays):
+        """
+            Load an index from the arrays returned by to_arrays(). The arrays are not copied, so they may be
+            views into a shared memory buffer. Queries are vectorized against the stored vocabulary and idf
+            weights, so no vectorizer needs to be unpickled.
+        """
+        self.vectorizer = TrigramVectorizer(arrays["vocab"], arrays["idf"])
+        self.ids = arrays["ids"]
+        self.texts = (arrays["text_offsets"], arrays["text"])
+        self.matrix = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                                 shape=(len(self.ids), len(arrays["vocab"])), copy=False)
+        self.create_index()
+
+    def transform_queries(self, query_strings):
+        """ Turn a list of query strings into a tf-idf matrix with one row per query. """
+        return self.vectorizer.transform(query_strings)
 
     def save(self, index_dir):
         v_file = os.path.join(index_dir, "%s_nmslib_vectorizer.pickle" % self.name)
@@ -58,32 +272,68 @@ class FuzzyIndex:
 
         with open(v_file, "wb") as f:
             pickle.dump(self.vectorizer, f)
-        self.index.saveIndex(i_file, save_data=True)
+        # Saved indexes are always loaded with the nmslib backend
+        index = self.index if self.backend == BACKEND_NMSLIB else self.create_nmslib_index()
+        index.saveIndex(i_file, save_data=True)
         with open(d_file, "wb") as f:
-            pickle.dump(self.index_data, f)
-            
-    def save_to_mem(self, temp_dir):
-        # TODO: Use scikit to pickle the vectorizer for better memory performance
-        # TODO: Do not save the additional data, its only used for debugging
-        vec = pickle.dumps(self.vectorizer)
-        additional_data = pickle.dumps(self.index_data)
-
-        i_file = os.path.join(temp_dir, "%d.pickle" % os.getpid())
-        self.index.saveIndex(i_file, save_data=True)
-        with open(i_file, "rb") as f:
-            index = f.read()
-        os.unlink(i_file)
-        
-        i_dat_file = os.path.join(temp_dir, "%d.pickle.dat" % os.getpid())
-        with open(i_dat_file, "rb") as f:
-            index_data = f.read()
-        os.unlink(i_dat_file)
-
-        # Ready for pickling
-        return { "vec": vec,
-                 "index": index,
-                 "index_data": index_data,
-                 "additional_data": additional_data }
+            pickle.dump(self.documents(), f)
+
+        self.save_arrays(index_dir)
+
+    def save_arrays(self, index_dir):
+        """
+            Save the vocabulary, the posting lists, the documents and the exact index as .npy files, for
+            load_arrays(). The files are written to a new directory that then replaces the old one, so
+            that processes which have the old files mapped can keep using them.
+        """
+        arrays = self.to_arrays()
+        postings = self.matrix.T.tocsr()
+        # Both index arrays get the same type, so that scipy doesn't convert (and copy) them when loaded
+        index_type = np.int32 if postings.nnz < 2 ** 31 else np.int64
+        if self.exact_hashes is None:
+            self.create_exact_index()
+        arrays = { "vocab": arrays["vocab"],
+                   "idf": arrays["idf"],
+                   "ids": arrays["ids"],
+                   "text_offsets": arrays["text_offsets"],
+                   "text": arrays["text"],
+                   "postings_indptr": postings.indptr.astype(index_type),
+                   "postings_docs": postings.indices.astype(index_type),
+                   "postings_weights": postings.data.astype(np.float32),
+                   "exact_hashes": self.exact_hashes,
+                   "exact_order": self.exact_order }
+
+        path = os.path.join(index_dir, ARRAYS_DIR % self.name)
+        shutil.rmtree(path + ".tmp", ignore_errors=True)
+        os.makedirs(path + ".tmp")
+        for name, array in arrays.items():
+            np.save(os.path.join(path + ".tmp", name + ".npy"), array)
+        replace_dir(path + ".tmp", path)
+
+    def load_arrays(self, index_dir):
+        """
+            Memory map an index saved by save_arrays(). Nothing is copied or unpickled, so this is fast and
+            all processes that load the same index share its pages. The index is searched with
+            BACKEND_INVERTED. Returns False if the index has no saved arrays.
+        """
+        path = os.path.join(index_dir, ARRAYS_DIR % self.name)
+        try:
+            # stat before loading: if the directory is swapped while loading, the index looks older than it is
+            self.stat = os.stat(path)
+            arrays = { name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in ARRAY_NAMES }
+        except FileNotFoundError:
+            return False
+
+        self.vectorizer = TrigramVectorizer(arrays["vocab"], arrays["idf"])
+        self.ids = arrays["ids"]
+        self.texts = (arrays["text_offsets"], arrays["text"])
+        self.matrix = None
+        self.backend = BACKEND_INVERTED
+        self.index = csr_matrix((arrays["postings_weights"], arrays["postings_docs"], arrays["postings_indptr"]),
+                                shape=(len(arrays["vocab"]), len(self.ids)), copy=False)
+        self.exact_hashes = arrays["exact_hashes"]
+        self.exact_order = arrays["exact_order"]
+        return True
 
     def load(self, index_dir):
         v_file = os.path.join(index_dir, "%s_nmslib_vectorizer.pickle" % self.name)
@@ -91,57 +341,186 @@ class FuzzyIndex:
         d_file = os.path.join(index_dir, "%s_additional_index_data.pickle" % self.name)
 
         try:
+            self.stat = os.stat(i_file)
             with open(v_file, "rb") as f:
                 self.vectorizer = pickle.load(f)
+            # Saved indexes don't include the tf-idf matrix, so they can only be searched with nmslib
+            import nmslib
+            self.backend = BACKEND_NMSLIB
+            self.index = nmslib.init(method='simple_invindx', space='negdotprod_sparse_fast', data_type=nmslib.DataType.SPARSE_VECTOR)
             self.index.loadIndex(i_file, load_data=True)
             with open(d_file, "rb") as f:
-                self.index_data = pickle.load(f)
+                index_data = pickle.load(f)
+            self.set_documents(np.fromiter((x["id"] for x in index_data), dtype=np.int64, count=len(index_data)),
+                               [ x["text"] for x in index_data ])
             return True
         except OSError:
             return False
 
-    def load_from_mem(self, data, temp_dir):
+    def remove(self, index_dir):
+        """ Remove a saved index """
+        self.remove_nmslib(index_dir)
+        shutil.rmtree(os.path.join(index_dir, ARRAYS_DIR % self.name), ignore_errors=True)
+
+    def remove_nmslib(self, index_dir):
+        """ Remove the files of a saved index that load() reads, but not the arrays that load_arrays() maps """
+        for name in ("nmslib_vectorizer.pickle", "nmslib_index.pickle", "nmslib_index.pickle.dat", "additional_index_data.pickle"):
+            try:
+                os.unlink(os.path.join(index_dir, "%s_%s" % (self.name, name)))
+            except FileNotFoundError:
+                pass
+
+    def text(self, i):
+        """ Return the text of document i """
+        return unpack_string(*self.texts, i)
 
-        self.vectorizer = pickle.loads(data["vec"])
-        self.index_data = pickle.loads(data["additional_data"])
+    def result(self, i, confidence):
+        """ Return a new search result dict for document i """
+        return { "text": unpack_string(*self.texts, i), "id": int(self.ids[i]), "confidence": confidence }
 
-        i_file = os.path.join(temp_dir, "%d.pickle" % os.getpid())
-        with open(i_file, "wb") as f:
-            f.write(data["index"])
-        i_dat_file = os.path.join(temp_dir, "%d.pickle.dat" % os.getpid())
-        with open(i_dat_file, "wb") as f:
-            f.write(data["index_data"])
-        self.index.loadIndex(i_file, load_data=True)
-        os.unlink(i_file)
-        os.unlink(i_dat_file)
+    def doc_ids(self, docs):
+        """ Return the ids of an array of documents """
+        return self.ids[docs]
+
+    def create_exact_index(self):
+        """ Hash the text of all documents, so that exact_search_batch() can find exact matches without a knn search """
+        num_docs = len(self.ids)
+        hashes = np.fromiter((text_hash(self.text(i)) for i in range(num_docs)), dtype=np.int64, count=num_docs)
+        self.exact_order = np.argsort(hashes, kind="stable")
+        self.exact_hashes = hashes[self.exact_order]
+
+    def exact_search_batch(self, query_strings):
+        """
+            Return, for each query string, an (ids, confidences) pair of arrays like search_arrays() with the
+            documents whose text is exactly the query string, in index order and with a confidence of 1.0.
+            The arrays are empty if there is no exact match.
+        """
+        if self.exact_hashes is None:
+            raise IndexError("Must create the exact index before searching it")
+
+        hashes = np.array([ text_hash(query_string) for query_string in query_strings ], dtype=np.int64)
+        starts = np.searchsorted(self.exact_hashes, hashes, side="left").tolist()
+        ends = np.searchsorted(self.exact_hashes, hashes, side="right").tolist()
+        outputs = []
+        for query_string, start, end in zip(query_strings, starts, ends):
+            # Different texts can have the same hash, compare the texts
+            docs = np.array([ i for i in self.exact_order[start:end].tolist() if self.text(i) == query_string ], dtype=np.int64)
+            outputs.append((self.doc_ids(docs), np.ones(len(docs), dtype=np.float32)))
+
+        return outputs
+
+    def knn_query_batch(self, query_matrix, k):
+        """ Return a list of (ids, distances) with the k nearest neighbours of each query row, like nmslib does. """
+        if self.backend == BACKEND_NMSLIB:
+            return self.index.knnQueryBatch(query_matrix, k=k, num_threads=min(NMSLIB_THREADS, query_matrix.shape[0]))
+
+        # nmslib keeps the vectors and computes the dot products in single precision, so do the same. It
+        # adds up the products in its own order, so confidences can still differ from it in the last bit.
+        query_matrix = query_matrix.astype(np.float32)
+        if self.backend == BACKEND_INVERTED:
+            scores = (query_matrix @ self.index).tocsr()
+        else:
+            scores = (self.index @ query_matrix.T).tocsc()
+        results = []
+        for q in range(query_matrix.shape[0]):
+            # Only documents that share a term with the query are neighbours
+            ids = scores.indices[scores.indptr[q]:scores.indptr[q + 1]]
+            doc_scores = scores.data[scores.indptr[q]:scores.indptr[q + 1]]
+            if len(ids) > k:
+                top = np.sort(np.argpartition(-doc_scores, k - 1)[:k])
+                ids, doc_scores = ids[top], doc_scores[top]
+            order = np.lexsort((ids, -doc_scores))
+            results.append((ids[order], -doc_scores[order]))
+
+        return results
 
     def search(self, query_string, min_confidence, debug=False):
         """ Carry out search, returns list of dicts: "text", "id", "confidence" """
 
+        return self.search_batch([query_string], min_confidence, debug)[0]
+
+    def search_batch(self, query_strings, min_confidence, debug=False):
+        """ Carry out a search for each query string in one pass, returns a list of search() results """
+
         if self.index is None:
             raise IndexError("Must build index before searching")
 
-        query_matrix = self.vectorizer.transform([query_string])
+        query_matrix = self.transform_queries(query_strings)
 #        t0 = monotonic()
-        results = self.index.knnQueryBatch(query_matrix, k=NUM_FUZZY_SEARCH_RESULTS, num_threads=5)
+        results = self.knn_query_batch(query_matrix, k=NUM_FUZZY_SEARCH_RESULTS)
 #        print("search time: %.2fms" % ((monotonic() - t0) * 1000))
-        output = []
-        if debug:
-            print("Search results for '%s':" % query_string)
-        for i, conf in zip(results[0][0], results[0][1]):
-            data = self.index_data[i]
-            confidence = fabs(conf)
-            data["confidence"] = confidence
-            if confidence >= min_confidence:
-                output.append(data)
-                is_below=" "
-            else:
-                is_below="!"
+        outputs = []
+        for query_string, (ids, distances) in zip(query_strings, results):
+            output = []
+            if debug:
+                print("Search results for '%s':" % query_string)
+            for i, conf in zip(ids, distances):
+                confidence = fabs(conf)
+                data = self.result(i, confidence)
+                if confidence >= min_confidence:
+                    output.append(data)
+                    is_below=" "
+                else:
+                    is_below="!"
+
+                if debug:
+                    print("%c %-30s %10d %.3f" % (is_below, data["text"][:30], data["id"], data["confidence"]))
 
             if debug:
-                print("%c %-30s %10d %.3f" % (is_below, data["text"][:30], data["id"], data["confidence"]))
-        
-        if debug:
-            print()
+                print()
+            outputs.append(output)
+
+        return outputs
+
+    def search_arrays(self, query_strings, min_confidence, limit=None):
+        """
+            Search like search_batch(), but return an (ids, confidences) pair of arrays for each query,
+            best first. With a limit, only the first limit results and those that tie with the last of them
+            are returned. Each query starts with a small number of neighbours, which is only widened while
+            the last neighbour is still needed.
+        """
+
+        if self.index is None:
+            raise IndexError("Must build index before searching")
+
+        query_matrix = self.transform_queries(query_strings)
+        k = min(max(SEARCH_MIN_K, (limit or 0) + 1), NUM_FUZZY_SEARCH_RESULTS)
+        if limit is None and self.backend != BACKEND_NMSLIB:
+            # The other backends score all documents for any k, widening would only score them again
+            k = NUM_FUZZY_SEARCH_RESULTS
+        outputs = [ None ] * len(query_strings)
+        queries = list(range(len(query_strings)))
+        while queries:
+            results = self.knn_query_batch(query_matrix[queries], k=k)
+            widen = []
+            for q, (docs, distances) in zip(queries, results):
+                confidences = np.abs(distances)
+                count = result_count(confidences, min_confidence, limit)
+                if count == k and k < NUM_FUZZY_SEARCH_RESULTS:
+                    widen.append(q)
+                    continue
+                outputs[q] = (self.doc_ids(np.asarray(docs[:count])), confidences[:count])
+
+            queries = widen
+            k = min(k * SEARCH_WIDEN_FACTOR, NUM_FUZZY_SEARCH_RESULTS)
+
+        return outputs
+
+
+def text_hash(text):
+    """ Return a 64 bit hash of a string that, unlike hash(), is the same in every process """
+    return int.from_bytes(blake2b(text.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+def result_count(confidences, min_confidence, limit=None):
+    """
+        Return how many of a query's neighbours, sorted by decreasing confidence, are results: those that
+        have min_confidence and, with a limit, are among the first limit or tie with the last of those.
+    """
+
+    # Compare in double precision, like search_batch() does
+    count = int(np.searchsorted(-confidences.astype(np.float64), -min_confidence, side="right"))
+    if limit is not None and count > limit:
+        count = int(np.searchsorted(-confidences[:count], -confidences[limit - 1], side="right"))
 
-        return output
\ No newline at end of file
+    return count
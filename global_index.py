@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+from array import array
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from artist_data import doc_rows
+from database import open_db, db
+from fuzzy_index import NUM_FUZZY_SEARCH_RESULTS, result_count
+from search_index import artist_documents
+from trigram_vectorizer import TrigramVectorizer, trigram_codes
+from utils import replace_dir
+
+# A single trigram -> posting list index over the recordings and releases of all artists, as an alternative
+# to building or loading a pair of indexes per artist. Documents are numbered artist by artist, so each
+# artist owns a contiguous range of document ids and every posting list is sorted by artist. A search for
+# one artist only scores the slice of each posting list that falls into the artist's range.
+#
+# Each document belongs to exactly one artist, so the posting weights are the tf-idf weights of the per-artist
+# index. The query's idf weights come from the size of the artist's slice of each posting list. Confidences
+# therefore match what the per-artist indexes compute.
+
+GLOBAL_INDEX_DIR = "global_index"
+KINDS = ("recording", "release")
+
+
+class InvertedTrigramIndex:
+    """ The posting lists and document tables for either the recordings or the releases of all artists """
+
+    def __init__(self, arrays):
+        self.terms = arrays["terms"]
+        self.term_offsets = arrays["term_offsets"]
+        self.docs = arrays["docs"]
+        self.weights = arrays["weights"]
+        self.artist_ids = arrays["artist_ids"]
+        self.artist_doc_offsets = arrays["artist_doc_offsets"]
+        self.row_offsets = arrays["row_offsets"]
+        self.rows = arrays["rows"]
+
+    def artist_range(self, artist_credit_id):
+        """ Return the (start, end) document range of an artist, which is empty for unknown artists """
+        i = np.searchsorted(self.artist_ids, artist_credit_id)
+        if i == len(self.artist_ids) or self.artist_ids[i] != artist_credit_id:
+            return 0, 0
+        return int(self.artist_doc_offsets[i]), int(self.artist_doc_offsets[i + 1])
+
+    def search_arrays(self, start, end, query_strings, min_confidence, limit=None):
+        """ Search the documents in [start, end) for each query, returns a list of FuzzyIndex.search_arrays() results """
+
+        num_docs = end - start
+        rows, codes = trigram_codes(query_strings)
+        outputs = []
+        for q in range(len(query_strings)):
+            query_codes, counts = np.unique(codes[rows == q], return_counts=True)
+            ids, confidences = self._score(start, num_docs, query_codes, counts)
+            count = result_count(confidences, min_confidence, limit)
+            outputs.append((ids[:count] + start, confidences[:count]))
+
+        return outputs
+
+    def _score(self, start, num_docs, query_codes, counts):
+        """ Return the documents (relative to start) that share a trigram with the query and their scores, best first """
+        ranges = []
+        weights = []
+        terms = np.searchsorted(self.terms, query_codes)
+        for code, term, count in zip(query_codes, terms, counts):
+            if term == len(self.terms) or self.terms[term] != code:
+                continue
+            lo, hi = self.term_offsets[term], self.term_offsets[term + 1]
+            first = lo + np.searchsorted(self.docs[lo:hi], start)
+            last = lo + np.searchsorted(self.docs[lo:hi], start + num_docs)
+            if first == last:
+                continue
+            ranges.append((first, last))
+            # idf as TfidfVectorizer computes it over the artist's documents
+            weights.append(count * (np.log((1 + num_docs) / (1 + (last - first))) + 1))
+
+        if not ranges:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        weights = np.array(weights)
+        weights /= np.sqrt(np.dot(weights, weights))
+        # Score in single precision like FuzzyIndex, term by term like its sparse product
+        scores = np.zeros(num_docs, dtype=np.float32)
+        for (first, last), weight in zip(ranges, weights.astype(np.float32)):
+            scores[self.docs[first:last] - start] += weight * self.weights[first:last]
+
+        # Rank like FuzzyIndex: highest confidence first, ties by document
+        ids = np.flatnonzero(scores > 0)
+        if len(ids) > NUM_FUZZY_SEARCH_RESULTS:
+            ids = np.sort(ids[np.argpartition(-scores[ids], NUM_FUZZY_SEARCH_RESULTS - 1)[:NUM_FUZZY_SEARCH_RESULTS]])
+        ids = ids[np.lexsort((ids, -scores[ids]))]
+
+        return ids, scores[ids]
+
+
+class ArtistRangeIndex:
+    """ One artist's slice of an InvertedTrigramIndex, searchable with search_arrays() like a FuzzyIndex """
+
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+
+    def search_arrays(self, query_strings, min_confidence, limit=None):
+        return self.index.search_arrays(self.start, self.end, query_strings, min_confidence, limit)
+
+
+class GlobalArtistData:
+    """ One artist's view of the global index, with the same search interface as ArtistData """
+
+    def __init__(self, global_index, artist_credit_id):
+        self.global_index = global_index
+        self.recording_index = None
+        self.release_index = None
+
+        rec_start, rec_end = global_index.recordings.artist_range(artist_credit_id)
+        rel_start, rel_end = global_index.releases.artist_range(artist_credit_id)
+        # Like packed artist data, an artist without recordings or without releases is empty
+        if rec_start == rec_end or rel_start == rel_end:
+            return
+
+        self.recording_index = ArtistRangeIndex(global_index.recordings, rec_start, rec_end)
+        self.release_index = ArtistRangeIndex(global_index.releases, rel_start, rel_end)
+
+    @property
+    def is_empty(self):
+        return self.recording_index is None
+
+    def recording_rows(self, docs):
+        """ Return the rows of an array of recording documents like ArtistData.recording_rows() """
+        recordings = self.global_index.recordings
+        rows, positions = doc_rows(recordings.row_offsets, docs)
+        rows = recordings.rows[rows]
+        return rows[:, 0], rows[:, 1], rows[:, 2], positions
+
+    def release_rows(self, docs):
+        """ Return the rows of an array of release documents like ArtistData.release_rows() """
+        releases = self.global_index.releases
+        rows, positions = doc_rows(releases.row_offsets, docs)
+        rows = releases.rows[rows]
+        return rows[:, 0], rows[:, 1], positions
+
+
+class GlobalIndex:
+    """ The memory mapped global recording and release indexes """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        path = os.path.join(index_dir, GLOBAL_INDEX_DIR)
+        # stat before loading: if the directory is swapped while loading, replaced() notices it
+        self.stat = os.stat(path)
+        indexes = {}
+        for kind in KINDS:
+            arrays = {}
+            for name in ("terms", "term_offsets", "docs", "weights", "artist_ids", "artist_doc_offsets",
+                         "row_offsets", "rows"):
+                arrays[name] = np.load(os.path.join(path, "%s_%s.npy" % (kind, name)), mmap_mode="r")
+            indexes[kind] = InvertedTrigramIndex(arrays)
+
+        self.recordings = indexes["recording"]
+        self.releases = indexes["release"]
+
+    @staticmethod
+    def open(index_dir):
+        """ Open the global index in index_dir, returns None if it has not been built """
+        try:
+            return GlobalIndex(index_dir)
+        except FileNotFoundError:
+            return None
+
+    def replaced(self):
+        """ Return True if build_global_index() has swapped in a new index since this one was opened """
+        try:
+            stat = os.stat(os.path.join(self.index_dir, GLOBAL_INDEX_DIR))
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_dev) != (self.stat.st_ino, self.stat.st_dev)
+
+    def reopen(self):
+        """ Open the current global index in this index's directory, returns self if that fails """
+        return GlobalIndex.open(self.index_dir) or self
+
+    def artist(self, artist_credit_id):
+        return GlobalArtistData(self, artist_credit_id)
+
+
+class GlobalIndexBuilder:
+    """ Collect the documents of one kind, artist by artist, and write out the inverted index """
+
+    def __init__(self, kind, row_width):
+        self.kind = kind
+        self.row_width = row_width
+        self.num_docs = 0
+        self.postings = []
+        self.artist_ids = array("q")
+        self.artist_doc_offsets = array("q", [0])
+        self.row_counts = array("q")
+        self.rows = []
+
+    def add_artist(self, artist_credit_id, texts, offsets, columns):
+        """ Add an artist's documents, the rows of document i are [offsets[i], offsets[i + 1]) in columns """
+        if texts:
+            vectorizer = TrigramVectorizer()
+            matrix = vectorizer.fit_transform(texts).tocoo()
+            self.postings.append((vectorizer.vocabulary[matrix.col],
+                                  (matrix.row + self.num_docs).astype(np.int32),
+                                  matrix.data.astype(np.float32)))
+            self.num_docs += len(texts)
+            self.row_counts.extend(np.diff(offsets).tolist())
+            self.rows.append(np.column_stack(columns).astype(np.int64))
+
+        self.artist_ids.append(artist_credit_id)
+        self.artist_doc_offsets.append(self.num_docs)
+
+    def save(self, path):
+        codes = np.concatenate([ p[0] for p in self.postings ]) if self.postings else np.empty(0, dtype=np.int64)
+        docs = np.concatenate([ p[1] for p in self.postings ]) if self.postings else np.empty(0, dtype=np.int32)
+        weights = np.concatenate([ p[2] for p in self.postings ]) if self.postings else np.empty(0, dtype=np.float32)
+        self.postings = []
+
+        # Sort postings by term, then document -- which also sorts each posting list by artist
+        order = np.lexsort((docs, codes))
+        codes, docs, weights = codes[order], docs[order], weights[order]
+        terms, term_starts = np.unique(codes, return_index=True)
+        term_offsets = np.append(term_starts, len(codes)).astype(np.int64)
+
+        row_offsets = np.zeros(len(self.row_counts) + 1, dtype=np.int64)
+        np.cumsum(self.row_counts, out=row_offsets[1:])
+
+        arrays = { "terms": terms,
+                   "term_offsets": term_offsets,
+                   "docs": docs,
+                   "weights": weights,
+                   "artist_ids": np.array(self.artist_ids, dtype=np.int64),
+                   "artist_doc_offsets": np.array(self.artist_doc_offsets, dtype=np.int64),
+                   "row_offsets": row_offsets,
+                   "rows": np.concatenate(self.rows) if self.rows else np.empty((0, self.row_width), dtype=np.int64) }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, "%s_%s.npy" % (self.kind, name)), array)
+
+
+def build_global_index(index_dir):
+    """
+        Build the global recording and release indexes from mapping.db in index_dir. The index is written
+        to a new directory that then replaces the old one, which servers may still have memory mapped.
+    """
+
+    path = os.path.join(index_dir, GLOBAL_INDEX_DIR)
+    shutil.rmtree(path + ".tmp", ignore_errors=True)
+    os.makedirs(path + ".tmp")
+    open_db(os.path.join(index_dir, "mapping.db"))
+
+    recordings = GlobalIndexBuilder("recording", 3)
+    releases = GlobalIndexBuilder("release", 2)
+
+    def add_artist(artist_credit_id, rows):
+        recording_texts, release_texts, tables = artist_documents(rows)
+        recordings.add_artist(artist_credit_id, recording_texts, tables["recording_offsets"],
+                              (tables["recording_recording_ids"], tables["recording_release_ids"], tables["recording_scores"]))
+        releases.add_artist(artist_credit_id, release_texts, tables["release_offsets"],
+                            (tables["release_release_ids"], tables["release_scores"]))
+
+    cursor = db.execute_sql("""SELECT artist_credit_id, recording_id, recording_name, release_id, release_name, score
+                                 FROM mapping
+                             ORDER BY artist_credit_id, rowid""")
+    current = None
+    rows = []
+    for i, row in enumerate(cursor):
+        if row[0] != current:
+            if rows:
+                add_artist(current, rows)
+            current = row[0]
+            rows = []
+        rows.append(row[1:])
+        if i % 1000000 == 0:
+            print("Indexed %d rows" % i)
+    if rows:
+        add_artist(current, rows)
+
+    print("Save global index")
+    recordings.save(path + ".tmp")
+    releases.save(path + ".tmp")
+    replace_dir(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: global_index.py <index dir>")
+        sys.exit(-1)
+
+    build_global_index(sys.argv[1])
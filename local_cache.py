@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import mmap
+import threading
+
+from artist_data import ArtistData
+
+
+class LocalArtistDataCache:
+    """
+        A per-process LRU of ready to query ArtistData, bounded by the total size of the packed data. Each
+        entry remembers the generation its artist had when it was loaded (see
+        SharedMemoryArtistDataCache.generation) and is dropped once the artist's generation changes.
+
+        Entries hold their own copy of data loaded from a shared memory segment, rather than the segment's
+        mapping. The shared cache can then evict and unlink a segment while this process still has the artist
+        here, without the segment staying in tmpfs beyond the shared cache's max_cache_size. Data from the
+        artist store is kept as it is, its pages are shared by all processes through the page cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, artist_id, generation):
+        with self.lock:
+            entry = self.entries.get(artist_id)
+            if entry is not None and entry[1] != generation:
+                self.remove(artist_id)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(artist_id)
+            return entry[0]
+
+    def put(self, artist_id, artist_data, generation):
+        size = len(artist_data.buffer)
+        if size > self.max_size:
+            return
+
+        # Shared memory segments are mapped whole as mmap objects, store entries are memoryviews of the store
+        if isinstance(artist_data.buffer, mmap.mmap):
+            artist_data = ArtistData(bytes(artist_data.buffer))
+
+        with self.lock:
+            if artist_id in self.entries:
+                self.remove(artist_id)
+            self.entries[artist_id] = (artist_data, generation)
+            self.size += size
+            while self.size > self.max_size:
+                artist_data, generation = self.entries.popitem(last=False)[1]
+                self.size -= len(artist_data.buffer)
+
+    def remove(self, artist_id):
+        """ Remove an entry, call with the lock held """
+        artist_data, generation = self.entries.pop(artist_id)
+        self.size -= len(artist_data.buffer)
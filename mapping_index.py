@@ -1,18 +1,21 @@
 #!/usr/bin/env python3
 
-import csv
+from array import array
+import concurrent.futures
+from hashlib import md5
 from time import monotonic
-from pickle import dumps, dump
-from subprocess import Popen, PIPE
 import os
+import shutil
 import sys
 
 from alphabet_detector import AlphabetDetector
 import psycopg2
-from psycopg2.extras import DictCursor, execute_values
 
 from fuzzy_index import FuzzyIndex
-from database import Mapping, create_db, open_db, db
+from artist_store import ArtistStore, ArtistStoreWriter
+from database import Mapping, create_db, open_db, db, CREATE_RESULT_TABLE, RESULT_COLUMNS
+from global_index import GLOBAL_INDEX_DIR, build_global_index
+from search_index import MappingLookupSearch
 
 # TODO: Remove the combined field of canonical data dump. Done, but make PR
 
@@ -23,180 +26,476 @@ DB_CONNECT = "dbname=musicbrainz_db user=musicbrainz host=localhost port=5432 pa
 #DB_CONNECT = "dbname=musicbrainz_db user=musicbrainz host=musicbrainz-docker_db_1 port=5432 password=musicbrainz"
 
 ARTIST_CONFIDENCE_THRESHOLD = .45
-NUM_ROWS_PER_COMMIT = 25000
+FETCH_SIZE = 25000
 MAX_THREADS = 8
+NUM_PARTS = MAX_THREADS * 8
+PART_DIR = "parts"
+# Where the servers keep their shared memory cache, see server.py
+TEMP_DIR = "/mnt/tmpfs"
+
+MAPPING_QUERY = """ SELECT artist_credit_id
+                         , array_to_string(artist_mbids::TEXT[], ',')
+                         , artist_credit_name
+                         , (array_agg(a.sort_name ORDER BY acn.position))[1] as artist_credit_sortname
+                         , rel.id AS release_id
+                         , rel.gid::TEXT AS release_mbid
+                         , release_name
+                         , rec.id AS recording_id
+                         , rec.gid::TEXT AS recording_mbid
+                         , recording_name
+                         , score
+                      FROM mapping.canonical_musicbrainz_data_release_support
+                      JOIN recording rec
+                        ON rec.gid = recording_mbid
+                      JOIN release rel
+                        ON rel.gid = release_mbid
+                      JOIN artist_credit_name acn
+                        ON artist_credit_id = acn.artist_credit
+                      JOIN artist a
+                        ON acn.artist = a.id
+                     WHERE {condition}
+                  GROUP BY artist_credit_id
+                         , artist_mbids
+                         , artist_credit_name
+                         , release_name
+                         , rel.id
+                         , recording_name
+                         , rec.id
+                         , score
+                  ORDER BY artist_credit_id"""
+RANGE_CONDITION = "artist_credit_id >= %s AND artist_credit_id < %s"
+IDS_CONDITION = "artist_credit_id = ANY(%s)"
+
+# The columns of MAPPING_QUERY, in order
+MAPPING_COLUMNS = ("artist_credit_id", "artist_mbids", "artist_credit_name", "artist_credit_sortname", "release_id",
+                   "release_mbid", "release_name", "recording_id", "recording_mbid", "recording_name", "score")
+# The columns that digest_rows() and DIGEST_QUERY sort the rows of an artist credit by
+DIGEST_ORDER = ("release_id", "recording_id", "score")
+# An md5 digest of the MAPPING_QUERY rows of every artist credit, computed the same way as digest_rows()
+DIGEST_QUERY = """SELECT artist_credit_id
+                       , md5(string_agg(concat_ws(E'\\t', """ + ", ".join(MAPPING_COLUMNS[1:]) + """), E'\\n'
+                                        ORDER BY """ + ", ".join(DIGEST_ORDER) + """))
+                    FROM (""" + MAPPING_QUERY.format(condition="TRUE") + """) AS m(""" + ", ".join(MAPPING_COLUMNS) + """)
+                GROUP BY artist_credit_id"""
+
+# How many artist credits to delete with one statement, to stay below SQLite's variable limit
+DELETE_CHUNK_SIZE = 500
+
+# Copy mapping rows into mapping_result, see database.py
+INSERT_RESULTS = """INSERT INTO mapping_result
+                          SELECT release_id, recording_id, rowid, """ + RESULT_COLUMNS + """
+                            FROM mapping
+                           {condition}
+                        ORDER BY release_id, recording_id, rowid"""
+DELETE_RESULTS = """DELETE FROM mapping_result
+                          WHERE (release_id, recording_id, mapping_row) IN (SELECT release_id, recording_id, rowid
+                                                                              FROM mapping
+                                                                             WHERE {condition})"""
+
+INSERT_MAPPING = """INSERT INTO mapping (artist_credit_id, artist_mbids, artist_credit_name, artist_credit_sortname,
+                                         release_id, release_mbid, release_name,
+                                         recording_id, recording_mbid, recording_name, score)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+
+class ArtistTextBuffer:
+    """ Accumulate encoded artist names in one byte buffer, rather than one Python string each """
+
+    def __init__(self):
+        self.text = bytearray()
+        self.offsets = array("q", [0])
+
+    def append(self, text):
+        self.text.extend(text.encode("utf-8"))
+        self.offsets.append(len(self.text))
+
+    def index_data(self, ids):
+        """ Return the FuzzyIndex index data for the collected names and the given artist ids """
+        return [ { "text": self.text[self.offsets[i]:self.offsets[i + 1]].decode("utf-8"), "id": id }
+                 for i, id in enumerate(ids) ]
+
+
+def part_file(part_dir, start, end):
+    return os.path.join(part_dir, "mapping_%d_%d.db" % (start, end))
+
+
+def extract_range(part_dir, start, end):
+    """
+        Extract the mapping rows for artist_credit_ids in [start, end) into their own part database. The
+        part is written to a temp file and renamed when complete, so an existing part file marks the range
+        as done and a rerun skips it. Returns the number of rows extracted, or None if the range was skipped.
+    """
+
+    part = part_file(part_dir, start, end)
+    if os.path.exists(part):
+        return None
+
+    tmp_file = part + ".tmp"
+    create_db(tmp_file)
+    db.execute_sql("PRAGMA journal_mode = OFF")
+    db.execute_sql("PRAGMA synchronous = OFF")
+
+    num_rows = 0
+    conn = psycopg2.connect(DB_CONNECT)
+    try:
+        # A named cursor keeps the result set on the server, rows are fetched FETCH_SIZE at a time
+        with conn.cursor(name="mapping_index_%d" % start) as curs:
+            curs.execute(MAPPING_QUERY.format(condition=RANGE_CONDITION), (start, end))
+            db.execute_sql("BEGIN")
+            while True:
+                rows = curs.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+
+                db.cursor().executemany(INSERT_MAPPING, rows)
+                num_rows += len(rows)
+            db.execute_sql("COMMIT")
+    finally:
+        conn.close()
+        db.close()
+
+    os.rename(tmp_file, part)
+    return num_rows
 
-class MappingLookupIndex:
 
-    def create(self, conn, index_dir):
-        last_row = None
-        current_part_id = None
+class MappingLookupIndex:
 
-        t0 = monotonic()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as curs:
-            artist_data = []
-            stupid_artist_data = []  # reserved for stupid artists like !!!
-            recording_data = []
-            release_data = []
-            relrec_offsets = []
-            relrec_offset = 0
-
-            db_file = os.path.join(index_dir, "mapping.db")
-            create_db(db_file)
-            db.close()
-
-            print("execute query")
-            curs.execute(""" SELECT artist_credit_id
-                                  , artist_mbids::TEXT[]
-                                  , artist_credit_name
-                                  , COALESCE(array_agg(a.sort_name ORDER BY acn.position)) as artist_credit_sortname
-                                  , rel.id AS release_id
-                                  , rel.gid::TEXT AS release_mbid
-                                  , release_name
-                                  , rec.id AS recording_id
-                                  , rec.gid::TEXT AS recording_mbid
-                                  , recording_name
-                                  , score
-                               FROM mapping.canonical_musicbrainz_data_release_support
-                               JOIN recording rec
-                                 ON rec.gid = recording_mbid
-                               JOIN release rel
-                                 ON rel.gid = release_mbid
-                               JOIN artist_credit_name acn
-                                 ON artist_credit_id = acn.artist_credit
-                               JOIN artist a
-                                 ON acn.artist = a.id
-                              WHERE artist_credit_id < 10000
-                           GROUP BY artist_credit_id
-                                  , artist_mbids
-                                  , artist_credit_name
-                                  , release_name
-                                  , rel.id
-                                  , recording_name
-                                  , rec.id
-                                  , score
-                           ORDER BY artist_credit_id""")
-#                              WHERE artist_credit_id > 1230420 and artist_credit_id < 1230800
-
-            print("load data")
-            mapping_data = []
-            ad = AlphabetDetector()
-            import_file = os.path.join(index_dir, "import.csv")
-            with open(import_file, 'w', newline='') as csvfile:
-                fieldnames = ["artist_credit_id", 
-                              "artist_mbids", 
-                              "artist_credit_name", 
-                              "artist_credit_sortname", 
-                              "release_id", 
-                              "release_mbid", 
-                              "release_name", 
-                              "recording_id", 
-                              "recording_mbid", 
-                              "recording_name", 
-                              "score"]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect="unix")
-                for i, row in enumerate(curs):
-                    if i == 0:
-                        continue
-
-                    if i % 1000000 == 0:
-                        print("Indexed %d rows" % i)
-
-                    if last_row is not None and row["artist_credit_id"] != last_row["artist_credit_id"]:
-
-                        # Save artist data for artist index
-                        encoded = FuzzyIndex.encode_string(last_row["artist_credit_name"])
-                        if encoded:
-                            artist_data.append({ "text": encoded,
-                                                 "id": last_row["artist_credit_id"] })
-                            if not ad.only_alphabet_chars(last_row["artist_credit_name"], "LATIN"):
-                                encoded = FuzzyIndex.encode_string(last_row["artist_credit_sortname"][0])
-                                if encoded:
-                                    # 幾何学模様 a                  Kikagaku Moyo c
-                                    artist_data.append({ "text": encoded,
-                                                         "id": last_row["artist_credit_id"] })
-
-                        else:
-                            encoded = FuzzyIndex.encode_string_for_stupid_artists(last_row["artist_credit_name"])
-                            if not encoded:
-                                last_row = row
-                                continue
-                            stupid_artist_data.append({ "text": encoded, 
-                                                        "id": last_row["artist_credit_id"] })
-
-                        recording_data = []
-                        release_data = []
-                
-                    arow = dict(row)
-                    arow["artist_mbids"] = ",".join(row["artist_mbids"])
-                    arow["artist_credit_sortname"] = row["artist_credit_sortname"][0]
-                    mapping_data.append(arow)
-
-                    last_row = row
-
-                    if len(mapping_data) > NUM_ROWS_PER_COMMIT:
-                        for mrow in mapping_data:
-                            writer.writerow(mrow)
-                        mapping_data = []
-
-                # dump out the last bits of data
-                encoded = FuzzyIndex.encode_string(row["artist_credit_name"])
+    def __init__(self):
+        self.artist_ids = array("q")
+        self.artist_text = ArtistTextBuffer()
+        self.stupid_artist_ids = array("q")  # reserved for stupid artists like !!!
+        self.stupid_artist_text = ArtistTextBuffer()
+        self.ad = AlphabetDetector()
+
+    def add_artist(self, artist_credit_id, artist_credit_name, artist_credit_sortname):
+        """ Save artist data for artist index """
+
+        encoded = FuzzyIndex.encode_string(artist_credit_name)
+        if encoded:
+            self.artist_ids.append(artist_credit_id)
+            self.artist_text.append(encoded)
+            if not self.ad.only_alphabet_chars(artist_credit_name, "LATIN"):
+                encoded = FuzzyIndex.encode_string(artist_credit_sortname)
                 if encoded:
-                    artist_data.append({ "text": encoded,
-                                         "id": row["artist_credit_id"] })
+                    # 幾何学模様 a                  Kikagaku Moyo c
+                    self.artist_ids.append(artist_credit_id)
+                    self.artist_text.append(encoded)
+        else:
+            encoded = FuzzyIndex.encode_string_for_stupid_artists(artist_credit_name)
+            if encoded:
+                self.stupid_artist_ids.append(artist_credit_id)
+                self.stupid_artist_text.append(encoded)
+
+    def partition(self):
+        """ Split the artist_credit_id space into NUM_PARTS [start, end) ranges """
+
+        conn = psycopg2.connect(DB_CONNECT)
+        try:
+            with conn.cursor() as curs:
+                curs.execute("""SELECT min(artist_credit_id), max(artist_credit_id)
+                                  FROM mapping.canonical_musicbrainz_data_release_support""")
+                low, high = curs.fetchone()
+        finally:
+            conn.close()
+
+        if low is None:
+            return []
+
+        step = (high - low) // NUM_PARTS + 1
+        return [ (start, min(start + step, high + 1)) for start in range(low, high + 1, step) ]
+
+    def extract(self, part_dir, ranges):
+        """ Extract all ranges that have no part file yet, MAX_THREADS ranges at a time """
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_THREADS) as exe:
+            futures = { exe.submit(extract_range, part_dir, start, end): (start, end) for start, end in ranges }
+            for future in concurrent.futures.as_completed(futures):
+                start, end = futures[future]
+                num_rows = future.result()
+                if num_rows is None:
+                    print("range %d-%d already extracted" % (start, end))
                 else:
-                    encoded = FuzzyIndex.encode_string_for_stupid_artists(last_row["artist_credit_name"])
-                    stupid_artist_data.append({ "text": encoded,
-                                               "id": row["artist_credit_id"] })
+                    print("range %d-%d: extracted %d rows" % (start, end, num_rows))
+
+    def merge(self, db_file, part_dir, ranges):
+        """ Copy the part databases into db_file in artist_credit_id order and collect the artist names """
+
+        create_db(db_file)
+        # The database is built from scratch, so there is nothing to recover if the build fails
+        db.execute_sql("PRAGMA journal_mode = OFF")
+        db.execute_sql("PRAGMA synchronous = OFF")
+
+        for start, end in ranges:
+            db.execute_sql("ATTACH DATABASE ? AS part", (part_file(part_dir, start, end),))
+            db.execute_sql("BEGIN")
+            db.execute_sql("INSERT INTO mapping SELECT * FROM part.mapping ORDER BY rowid")
+            db.execute_sql("COMMIT")
+            cursor = db.execute_sql("""SELECT artist_credit_id, artist_credit_name, artist_credit_sortname
+                                         FROM part.mapping
+                                     GROUP BY artist_credit_id
+                                     ORDER BY artist_credit_id""")
+            for row in cursor:
+                self.add_artist(*row)
+            db.execute_sql("DETACH DATABASE part")
+
+        create_mapping_indexes()
+        db.close()
+
+    def create(self, index_dir, resume=False):
+        """
+            Build mapping.db and the artist indexes. The data is extracted in artist_credit_id ranges on
+            MAX_THREADS connections. If resume is set, ranges extracted by an earlier, failed build are reused.
+        """
 
-                if mapping_data:
-                    for mrow in mapping_data:
-                        writer.writerow(mrow)
+        t0 = monotonic()
 
+        part_dir = os.path.join(index_dir, PART_DIR)
+        if not resume:
+            shutil.rmtree(part_dir, ignore_errors=True)
+        os.makedirs(part_dir, exist_ok=True)
+
+        print("extract data")
+        ranges = self.partition()
+        self.extract(part_dir, ranges)
+
+        print("merge data")
+        self.merge(os.path.join(index_dir, "mapping.db"), part_dir, ranges)
+        shutil.rmtree(part_dir)
+
+        self.save_artist_indexes(index_dir)
+
+        t1 = monotonic()
+        print("loaded data and build artist indexes in %.1f seconds." % (t1 - t0))
 
-        print("Import data into SQLite")
-        try:
-            with Popen(['sqlite3', db_file], stdin=PIPE, stdout=PIPE, universal_newlines=True, bufsize=1) as sql:
-                print('.separator ","', file=sql.stdin, flush=True)
-                print(".import '%s' mapping" % import_file, file=sql.stdin, flush=True)
-                print("create index artist_credit_id_ndx on mapping(artist_credit_id);", file=sql.stdin, flush=True)
-                print("create index release_id_ndx on mapping(release_id);", file=sql.stdin, flush=True)
-                print("create index recording_id_ndx on mapping(recording_id);", file=sql.stdin, flush=True)
-                print("create index release_id_recording_id_ndx on mapping(release_id, recording_id);", file=sql.stdin, flush=True)
-        except subprocess.CalledProcessError as err:
-            print("Failed to import data into SQLite: ", err)
-            return
 
-        # Get rid of the CSV files now that we've imported it
-        os.unlink(import_file)
+    def save_artist_indexes(self, index_dir):
+        """ Build the artist indexes from the artists added with add_artist() and save them to index_dir """
 
         print("Build/save artist indexes")
         artist_index = FuzzyIndex(name="artist_index")
-        artist_index.build(artist_data, "text")
+        artist_index.build(self.artist_text.index_data(self.artist_ids), "text")
         artist_index.save(index_dir)
 
-        if stupid_artist_data:
+        if self.stupid_artist_ids:
             print("Build/save stupid artist indexes")
             stupid_artist_index = FuzzyIndex(name="stupid_artist_index")
-            stupid_artist_index.build(stupid_artist_data, "text")
+            stupid_artist_index.build(self.stupid_artist_text.index_data(self.stupid_artist_ids), "text")
             stupid_artist_index.save(index_dir)
 
+    def refresh(self, index_dir, temp_dir, artist_credit_ids):
+        """
+            Update mapping.db, the artist store and the artist indexes for the given artist credits only.
+            Their mapping rows are replaced with fresh ones from Postgres, artist credits that Postgres no
+            longer has are removed. Then their entries in the artist store and the artist indexes are
+            replaced and their shared memory segments removed, so that running servers load the new data.
+            The global index, if it was built, is built again from the updated mapping.db.
+        """
+
+        # Only a refresh touches the servers' shared memory cache, a full build doesn't need it
+        from shared_mem_cache import SharedMemoryArtistDataCache
+
+        t0 = monotonic()
+        artist_credit_ids = sorted(set(artist_credit_ids))
+        open_db(os.path.join(index_dir, "mapping.db"))
+        # Running servers read mapping.db while it is updated. In WAL mode they keep reading the last
+        # committed state instead of waiting for the update to finish.
+        db.execute_sql("PRAGMA journal_mode = WAL")
+        cache = SharedMemoryArtistDataCache(temp_dir, 0)
+        ms = MappingLookupSearch(cache, index_dir)
+        store = ArtistStore.open(index_dir)
+
+        print("refresh %d artist credits" % len(artist_credit_ids))
+        conn = psycopg2.connect(DB_CONNECT)
+        try:
+            with conn.cursor(name="mapping_index_refresh") as curs, db.atomic():
+                has_results = db.table_exists("mapping_result")
+                for i in range(0, len(artist_credit_ids), DELETE_CHUNK_SIZE):
+                    chunk = artist_credit_ids[i:i + DELETE_CHUNK_SIZE]
+                    if has_results:
+                        db.execute_sql(DELETE_RESULTS.format(condition=chunk_condition(chunk)), chunk)
+                    Mapping.delete().where(Mapping.artist_credit_id.in_(chunk)).execute()
+
+                curs.execute(MAPPING_QUERY.format(condition=IDS_CONDITION), (artist_credit_ids,))
+                found = []
+                while True:
+                    rows = curs.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+
+                    db.cursor().executemany(INSERT_MAPPING, rows)
+                    for row in rows:
+                        if not found or found[-1] != row[0]:
+                            found.append(row[0])
+                            self.add_artist(row[0], row[2], row[3])
+
+                if has_results:
+                    for i in range(0, len(found), DELETE_CHUNK_SIZE):
+                        chunk = found[i:i + DELETE_CHUNK_SIZE]
+                        db.execute_sql(INSERT_RESULTS.format(condition="WHERE " + chunk_condition(chunk)), chunk)
+
+        finally:
+            conn.close()
+
+        if store is not None:
+            print("Update artist store")
+            self.refresh_artist_store(store, artist_credit_ids, found, ms)
+
+        for artist_credit_id in artist_credit_ids:
+            cache.invalidate(artist_credit_id)
+        print("%d artist credits updated, %d removed" % (len(found), len(artist_credit_ids) - len(found)))
+
+        print("Update artist indexes")
+        self.refresh_artist_index(index_dir, "artist_index", artist_credit_ids, self.artist_ids, self.artist_text)
+        self.refresh_artist_index(index_dir, "stupid_artist_index", artist_credit_ids,
+                                  self.stupid_artist_ids, self.stupid_artist_text)
+
+        if os.path.exists(os.path.join(index_dir, GLOBAL_INDEX_DIR)):
+            print("Rebuild global index")
+            build_global_index(index_dir)
+
         t1 = monotonic()
-        print("loaded data and build artist indexes in %.1f seconds." % (t1 - t0))
+        print("refreshed data and artist indexes in %.1f seconds." % (t1 - t0))
+
+    def refresh_artist_store(self, store, artist_credit_ids, found, ms):
+        """
+            Write a new artist store with the entries of the given artist credits replaced by fresh builds
+            for those that were found. The store is read-only, so all other entries are copied.
+        """
+
+        changed = set(artist_credit_ids)
+        writer = ArtistStoreWriter(store.path)
+        for artist_credit_id, buffer in store.items():
+            if artist_credit_id not in changed:
+                writer.add(artist_credit_id, buffer)
+        for artist_credit_id in found:
+            writer.add(artist_credit_id, ms.create_artist(artist_credit_id).buffer)
+        writer.close()
+
+    def refresh_artist_index(self, index_dir, name, artist_credit_ids, ids, text):
+        """
+            Replace the entries of the given artist credits in a saved artist index with the collected
+            ones. An index saved with arrays is updated with FuzzyIndex.update(), which only vectorizes the
+            collected names, and afterwards only has its arrays. Older indexes are built again from their
+            saved documents. Either way the result is that of a full build, up to rounding.
+        """
+
+        index = FuzzyIndex(name=name)
+        if index.load_arrays(index_dir):
+            try:
+                index.update(artist_credit_ids, text.index_data(ids), "text")
+            except ValueError:
+                index.remove(index_dir)
+                return
+            index.save_arrays(index_dir)
+            # The nmslib index still has the old entries, it must not be loaded instead of the arrays
+            index.remove_nmslib(index_dir)
+            return
+
+        index_data = index.documents() if index.load(index_dir) else []
+        changed = set(artist_credit_ids)
+        index_data = [ d for d in index_data if d["id"] not in changed ] + text.index_data(ids)
+        if not index_data:
+            index.remove(index_dir)
+            return
+
+        # Keep the order of a full build: artist_credit_id order, a name before its sort name
+        index_data.sort(key=lambda d: d["id"])
+        index = FuzzyIndex(name=name)
+        index.build(index_data, "text")
+        index.save(index_dir)
+
+
+def chunk_condition(chunk):
+    """ Return the condition that selects the mapping rows of a chunk of artist credit ids """
+    return "artist_credit_id IN (%s)" % ", ".join([ "?" ] * len(chunk))
+
+
+def create_mapping_indexes():
+    """
+        Create the SQLite indexes of the mapping table and the mapping_result table that search results are
+        read from, after mapping has been loaded
+    """
+
+    print("Create SQLite indexes")
+    db.execute_sql("CREATE INDEX artist_credit_id_ndx ON mapping(artist_credit_id)")
+    db.execute_sql("CREATE INDEX release_id_ndx ON mapping(release_id)")
+    db.execute_sql("CREATE INDEX recording_id_ndx ON mapping(recording_id)")
+
+    print("Create result table")
+    db.execute_sql("DROP TABLE IF EXISTS mapping_result")
+    db.execute_sql(CREATE_RESULT_TABLE)
+    db.execute_sql("BEGIN")
+    db.execute_sql(INSERT_RESULTS.format(condition=""))
+    db.execute_sql("COMMIT")
+
+
+def digest_rows(rows):
+    """ Return the digest of the mapping rows (in MAPPING_COLUMNS order) of one artist credit, see DIGEST_QUERY """
+
+    columns = [ MAPPING_COLUMNS.index(c) for c in DIGEST_ORDER ]
+    rows = sorted(rows, key=lambda row: [ row[c] for c in columns ])
+    text = "\n".join([ "\t".join([ str(v) for v in row[1:] if v is not None ]) for row in rows ])
+    return md5(text.encode("utf-8")).hexdigest()
+
+
+def changed_artist_credit_ids(index_dir):
+    """
+        Return the ids of the artist credits whose mapping rows in Postgres differ from those in mapping.db,
+        including artist credits that only one of them has. The rows are compared by digest, so any change
+        of the canonical data is found, whether or not the edit updated a last_updated column.
+    """
+
+    print("Digest mapping.db")
+    open_db(os.path.join(index_dir, "mapping.db"))
+    digests = {}
+    cursor = db.execute_sql("SELECT " + ", ".join(MAPPING_COLUMNS) + " FROM mapping ORDER BY artist_credit_id")
+    rows = []
+    for row in cursor:
+        if rows and row[0] != rows[0][0]:
+            digests[rows[0][0]] = digest_rows(rows)
+            rows = []
+        rows.append(row)
+    if rows:
+        digests[rows[0][0]] = digest_rows(rows)
+    db.close()
+
+    print("Digest canonical data")
+    changed = []
+    conn = psycopg2.connect(DB_CONNECT)
+    try:
+        with conn.cursor(name="mapping_index_digest") as curs:
+            curs.execute(DIGEST_QUERY)
+            while True:
+                rows = curs.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+
+                for artist_credit_id, digest in rows:
+                    if digests.pop(artist_credit_id, None) != digest:
+                        changed.append(artist_credit_id)
+    finally:
+        conn.close()
+
+    # What is left has been removed from the canonical data
+    return changed + list(digests)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: mapping_index.py <index dir>")
+    args = sys.argv[2:]
+    if len(sys.argv) < 2 or args not in ([], ["--resume"]) and args != ["--changed"] and (len(args) != 2 or args[0] != "--refresh"):
+        print("Usage: mapping_index.py <index dir> [--resume]")
+        print("       mapping_index.py <index dir> --refresh <file with one artist_credit_id per line>")
+        print("       mapping_index.py <index dir> --changed")
         sys.exit(-1)
 
     index_dir = sys.argv[1]
+    os.makedirs(index_dir, exist_ok=True)
 
     mi = MappingLookupIndex()
-    with psycopg2.connect(DB_CONNECT) as conn:
-        try:
-            os.makedirs(index_dir)
-        except OSError:
-            pass
-
-        mi.create(conn, index_dir)
+    if args and args[0] == "--refresh":
+        with open(args[1]) as f:
+            mi.refresh(index_dir, TEMP_DIR, [ int(line) for line in f if line.strip() ])
+    elif args and args[0] == "--changed":
+        mi.refresh(index_dir, TEMP_DIR, changed_artist_credit_ids(index_dir))
+    else:
+        mi.create(index_dir, resume=bool(args))
@@ -0,0 +1,221 @@
+from time import monotonic
+from uuid import uuid4
+import os
+
+from werkzeug.exceptions import NotFound
+from lb_matching_tools.cleaner import MetadataCleaner
+
+from database import ReadOnlyMappingDB
+from fuzzy_index import FuzzyIndex
+from stage_timer import (StageTimer, STAGE_ARTIST_SEARCH, STAGE_ARTIST_CLEANER, STAGE_RESULT_FETCH,
+                         COUNTER_EXACT_ARTIST_HITS, COUNTER_RESOLUTION_CACHE_HITS, COUNTER_RESOLUTION_CACHE_MISSES)
+
+SHORT_ARTIST_LENGTH = 5
+SHORT_ARTIST_CONFIDENCE = .5
+NORMAL_ARTIST_CONFIDENCE = .7
+
+# If the search hit is less than this, clean metadata and search those too!
+CLEANER_CONFIDENCE = .9
+
+
+class MappingLookup:
+    """
+        Look up (artist, release, recording) queries: resolve the artist name with the artist indexes, search
+        the candidate artists with a MappingLookupSearch and fetch the mapping rows of the hit. This is what
+        the server's search endpoints run.
+    """
+
+    def __init__(self, index_dir, ms, timer=None, resolution_cache=None):
+        """
+            With an ArtistResolutionCache, artist names that were resolved before, by any process, are
+            not searched again.
+        """
+        self.ms = ms
+        self.timer = timer or StageTimer()
+        self.resolution_cache = resolution_cache
+        self.db_file = os.path.join(index_dir, "mapping.db")
+        # One read-only connection per thread, shared with the search
+        self.mapping_db = ms.mapping_db if ms is not None else ReadOnlyMappingDB(self.db_file, self.timer)
+
+        # The artist indexes are memory mapped if they were saved with their arrays, so that all server
+        # processes share one copy. Older index dirs only have the pickled indexes, which each process loads.
+        self.artist_index = FuzzyIndex("artist_index")
+        if not self.artist_index.load_arrays(index_dir):
+            self.artist_index.load(index_dir)
+            self.artist_index.create_exact_index()
+
+        self.stupid_artist_index = FuzzyIndex("stupid_artist_index")
+        if not self.stupid_artist_index.load_arrays(index_dir) and not self.stupid_artist_index.load(index_dir):
+            self.stupid_artist_index = None
+
+        # Cached resolutions are only valid for the artist index they were made with. Every save replaces
+        # the saved index, so its inode and mtime identify it.
+        self.index_version = "%d.%d:" % (self.artist_index.stat.st_ino, self.artist_index.stat.st_mtime_ns)
+
+    def resolve_artists(self, artists):
+        """
+            Search the artist indexes for a list of artist names in one pass. Returns a list with,
+            for each artist, the candidate artist ids in decreasing confidence order and a dict of
+            artist id -> confidence. The id list is empty if the artist was not found.
+        """
+
+        if self.resolution_cache is None:
+            return [ (ids, dict(zip(ids, confidences))) for ids, confidences in self.search_artists(artists) ]
+
+        results = [ self.resolution_cache.get(self.index_version + artist) for artist in artists ]
+        missing = [ i for i, result in enumerate(results) if result is None ]
+        self.timer.count(COUNTER_RESOLUTION_CACHE_HITS, len(artists) - len(missing))
+        self.timer.count(COUNTER_RESOLUTION_CACHE_MISSES, len(missing))
+        if missing:
+            searched = self.search_artists([ artists[i] for i in missing ])
+            for i, (ids, confidences) in zip(missing, searched):
+                self.resolution_cache.put(self.index_version + artists[i], ids, confidences)
+                results[i] = (ids, confidences)
+
+        return [ (ids, dict(zip(ids, confidences))) for ids, confidences in results ]
+
+    def search_artists(self, artists):
+        """
+            Search the artist indexes for a list of artist names. Returns a list with the candidate ids
+            and the list of their confidences for each artist. Names that are exactly the name of one or
+            more artists resolve to those artists only, with a confidence of 1.0.
+        """
+
+        with self.timer.time(STAGE_ARTIST_SEARCH):
+            mc = MetadataCleaner()
+            results = [ ([], []) for artist in artists ]
+            encoded = FuzzyIndex.encode_strings(artists)
+
+            # Normal (not stupid) artists
+            normal = [ i for i, enc in enumerate(encoded) if enc ]
+            # (id, confidence) of the artists found for each artist name
+            found = {}
+            exact = self.artist_index.exact_search_batch([ encoded[i] for i in normal ])
+            for i, (ids, artist_confidences) in zip(normal, exact):
+                if len(ids):
+                    found[i] = list(zip(ids.tolist(), artist_confidences.tolist()))
+            self.timer.count(COUNTER_EXACT_ARTIST_HITS, len(found))
+            normal = [ i for i in normal if i not in found ]
+
+            confidences = {}
+            for i in normal:
+                if len(encoded[i]) <= SHORT_ARTIST_LENGTH:
+                    confidences[i] = SHORT_ARTIST_CONFIDENCE
+                else:
+                    confidences[i] = NORMAL_ARTIST_CONFIDENCE
+
+            if normal:
+                # Do a normal artist search
+                min_confidence = min(confidences.values())
+                searched = self.artist_index.search_arrays([ encoded[i] for i in normal ], min_confidence)
+                for i, (ids, artist_confidences) in zip(normal, searched):
+                    found[i] = [ a for a in zip(ids.tolist(), artist_confidences.tolist()) if a[1] >= confidences[i] ]
+
+                with self.timer.time(STAGE_ARTIST_CLEANER):
+                    cleaned = {}
+                    for i in normal:
+                        try:
+                            max_confidence = max([ a[1] for a in found[i] ])
+                        except ValueError:
+                            max_confidence = 0.0
+
+                        if max_confidence <= CLEANER_CONFIDENCE:
+                            cleaned_artist = self.artist_index.encode_string(mc.clean_artist(artists[i]))
+                            if cleaned_artist != encoded[i]:
+                                cleaned[i] = cleaned_artist
+
+                    if cleaned:
+                        searched = self.artist_index.search_arrays(list(cleaned.values()), min_confidence)
+                        for i, (ids, artist_confidences) in zip(cleaned, searched):
+                            found[i].extend([ a for a in zip(ids.tolist(), artist_confidences.tolist()) if a[1] >= confidences[i] ])
+
+                for i in normal:
+                    found[i] = sorted(found[i], key=lambda a: a[1], reverse=True)
+
+            # If the name contains no word characters (stoopid), search the stupid artists
+            stupid = [ i for i, enc in enumerate(encoded) if not enc ]
+            if stupid and self.stupid_artist_index:
+                searched = self.stupid_artist_index.search_arrays([ FuzzyIndex.encode_string_for_stupid_artists(artists[i]) for i in stupid ],
+                                                                  NORMAL_ARTIST_CONFIDENCE)
+                for i, (ids, artist_confidences) in zip(stupid, searched):
+                    found[i] = list(zip(ids.tolist(), artist_confidences.tolist()))
+
+            for i, artists_found in found.items():
+                # Collect the artist ids
+                results[i] = ([ a[0] for a in artists_found ], [ a[1] for a in artists_found ])
+
+        return results
+
+    def fetch_results(self, resp, conf_index, duration):
+        """ Fetch the mapping rows for a search hit and prepare them for the response """
+
+        release_id, recording_id, r_conf = resp
+        results = []
+        with self.timer.time(STAGE_RESULT_FETCH):
+            for d in self.mapping_db.mapping_rows(release_id, recording_id):
+                d["r_conf"] = r_conf
+                d["time"] = "%.1fms" % (duration * 1000)
+                # TODO: Investigate this exception
+                try:
+                    d["a_conf"] = conf_index[d["artist_credit_id"]]
+                except KeyError:
+                    d["a_conf"] = -1
+                del d["artist_credit_id"]
+                results.append(d)
+
+        return results
+
+    def mapping_search(self, artist, release, recording):
+
+        if not self.artist_index.encode_string(artist) and not self.stupid_artist_index:
+            return {}
+
+        ids, conf_index = self.resolve_artists([artist])[0]
+        if not ids:
+            raise NotFound("Artist '%s' was not found." % artist)
+
+        # Make the search request
+        req = {
+            "artist_ids": ids,
+            "artist_name": artist,
+            "release_name": release,
+            "recording_name": recording,
+            "id": str(uuid4())
+        }
+
+        t0 = monotonic()
+        resp = self.ms.search(req)
+        duration = monotonic() - t0
+        if resp is None:
+            raise NotFound("Not found")
+
+        return self.fetch_results(resp, conf_index, duration)
+
+    def mapping_search_batch(self, queries):
+        """
+            Search a list of (artist, release, recording) queries. Artists are resolved in one pass and
+            the searches are grouped by artist credit, so each artist is loaded once per batch. Returns a
+            list of results for each query, which is empty if nothing was found.
+        """
+
+        resolved = self.resolve_artists([ artist for artist, release, recording in queries ])
+        reqs = []
+        for (artist, release, recording), (ids, conf_index) in zip(queries, resolved):
+            reqs.append({ "artist_ids": ids,
+                          "artist_name": artist,
+                          "release_name": release,
+                          "recording_name": recording,
+                          "id": str(uuid4()) })
+
+        t0 = monotonic()
+        resps = self.ms.search_batch(reqs)
+        duration = monotonic() - t0
+
+        results = []
+        for resp, (ids, conf_index) in zip(resps, resolved):
+            if resp is None:
+                results.append([])
+            else:
+                results.append(self.fetch_results(resp, conf_index, duration))
+
+        return results
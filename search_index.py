@@ -1,269 +1,385 @@
 #!/usr/bin/env python3
 
 from collections import defaultdict
+import concurrent.futures
 from math import ceil
 from pickle import load, dumps, loads
 from random import randint
-from time import monotonic, sleep
+from time import monotonic
 from struct import unpack
 from multiprocessing import shared_memory
 from peewee import *
 import struct
 import os
 import sys
+import threading
 
-from peewee import DoesNotExist
+import numpy as np
 
+from artist_data import ArtistData, pack_artist_data
+from artist_store import ArtistStore
 from fuzzy_index import FuzzyIndex
+from local_cache import LocalArtistDataCache
+from stage_timer import (StageTimer, STAGE_ARTIST_LOAD_LOCAL, STAGE_ARTIST_LOAD_STORE, STAGE_ARTIST_LOAD_SHARED,
+                         STAGE_ARTIST_LOAD_BUILD, STAGE_ARTIST_LOAD_GLOBAL, STAGE_RECORDING_SEARCH, STAGE_RELEASE_SEARCH)
 from utils import split_dict_evenly
-from database import Mapping, IndexCache, open_db
+from database import ReadOnlyMappingDB
 
 RELEASE_CONFIDENCE = .5
 RECORDING_CONFIDENCE = .5
 
+# The thread pool that searches candidate artists, one per process and shared by all its request threads.
+# Created on first use, so that each (forked) server process gets its own threads, see search_executor().
+executor = None
+executor_pid = None
+executor_lock = threading.Lock()
+
+
+def search_executor(fan_out):
+    """
+        Return this process' thread pool for searching candidate artists. It has a thread per CPU, but at
+        least fan_out, however many request threads the process has.
+    """
+    global executor, executor_pid
+
+    with executor_lock:
+        if executor is None or executor_pid != os.getpid():
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(fan_out, os.cpu_count() or 1))
+            executor_pid = os.getpid()
+        return executor
+
+
+def artist_documents(rows):
+    """
+        Turn an artist's (recording_id, recording_name, release_id, release_name, score) mapping rows into
+        index documents: one per distinct encoded recording name and one per distinct encoded release
+        name. Returns (recording_texts, release_texts, tables): the encoded names to index, in document
+        order, and a dict of the arrays that map each document to its rows, as stored by pack_artist_data().
+    """
+
+    recording_names = FuzzyIndex.encode_strings([ row[1] for row in rows ])
+    release_names = FuzzyIndex.encode_strings([ row[3] for row in rows ])
+    recording_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    release_ids = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+    scores = np.fromiter((row[4] for row in rows), dtype=np.int64, count=len(rows))
+
+    # Recordings that have no word characters are skipped currently.
+    recording_docs = {}
+    docs = np.fromiter((recording_docs.setdefault(name, len(recording_docs)) if name else -1 for name in recording_names),
+                       dtype=np.int64, count=len(rows))
+    keep = np.flatnonzero(docs >= 0)
+    order = keep[np.argsort(docs[keep], kind="stable")]
+
+    # One release row per distinct (release_id, encoded release name), with the score of the last row
+    release_keys = {}
+    for recording_name, release_id, release_name, score in zip(recording_names, release_ids.tolist(), release_names, scores.tolist()):
+        if recording_name and release_name:
+            release_keys[(release_id, release_name)] = score
+    release_docs = {}
+    key_docs = np.fromiter((release_docs.setdefault(name, len(release_docs)) for release_id, name in release_keys),
+                           dtype=np.int64, count=len(release_keys))
+    key_ids = np.fromiter((release_id for release_id, name in release_keys), dtype=np.int64, count=len(release_keys))
+    key_scores = np.fromiter(release_keys.values(), dtype=np.int64, count=len(release_keys))
+    key_order = np.argsort(key_docs, kind="stable")
+
+    tables = { "recording_offsets": offsets(docs[keep], len(recording_docs)),
+               "recording_recording_ids": recording_ids[order],
+               "recording_release_ids": release_ids[order],
+               "recording_scores": scores[order],
+               "release_offsets": offsets(key_docs, len(release_docs)),
+               "release_release_ids": key_ids[key_order],
+               "release_scores": key_scores[key_order] }
+
+    return list(recording_docs), list(release_docs), tables
+
+
+def offsets(docs, num_docs):
+    """ Return the offsets of each document's rows, after sorting the rows by document """
+
+    result = np.zeros(num_docs + 1, dtype=np.int64)
+    np.cumsum(np.bincount(docs, minlength=num_docs), out=result[1:])
+    return result
+
+
 # TODO: read up on sqlite locking
 
 class MappingLookupSearch:
 
-    def __init__(self, cache, index_dir):
+    def __init__(self, cache, index_dir, global_index=None, local_cache_size=0, fan_out=1, timer=None):
+        """
+            If a GlobalIndex is given, artists are searched in it rather than in per-artist indexes
+            loaded from the artist store, the cache or built on the fly. With a local_cache_size (in
+            bytes), loaded artists are also kept in a per-process LRU in front of the shared cache. fan_out
+            is the number of candidate artists that are searched at the same time, see search_batch().
+            The time spent loading artists (by where they were found) and searching them is reported to
+            the StageTimer timer.
+        """
         self.index_dir = index_dir
         self.cache = cache
+        self.global_index = global_index
+        self.local_cache = LocalArtistDataCache(local_cache_size) if local_cache_size else None
+        self.fan_out = fan_out
+        self.timer = timer or StageTimer()
+        self.store = ArtistStore.open(index_dir)
 
         self.artist_index = None
         self.artist_data = {}
 
         self.db_file = os.path.join(index_dir, "mapping.db")
+        self.mapping_db = ReadOnlyMappingDB(self.db_file, self.timer)
 
     def create_artist(self, artist_credit_id):
 
-        recording_data = []
-        recording_releases = defaultdict(list)
-        release_data = {}
-        recording_ref = defaultdict(list)
+        data = self.mapping_db.artist_rows(artist_credit_id)
 
-        while True:
-            try:
-                data = Mapping.select().where(Mapping.artist_credit_id == artist_credit_id)
-                for i, row in enumerate(data):
-                    encoded = FuzzyIndex.encode_string(row.recording_name)
-                    # Recordings that have no word characters are skipped currently.
-                    if not encoded:
-                        continue
-                    recording_ref[encoded].append({ "id": row.recording_id,
-                                                    "release_id": row.release_id,
-                                                    "score": row.score })
-                    recording_releases[row.recording_id].append(row.release_id)
-
-                    encoded = FuzzyIndex.encode_string(row.release_name)
-                    if encoded:
-                        # Another data struct is needed from which to xref search results 
-                        # The int parssed to the index is the index of this list, where a list of release_ids are.
-                        release_data["%d-%s" % (row.release_id, encoded)] = row.score
-                break
-            except OperationalError:
-                sleep(.01)
-
-                                              
-        flattened = []
-        for r in release_data:
-            id, text = r.split("-", 1)
-            flattened.append({ "id": id,
-                               "text": text, 
-                               "score": release_data[r] })
-        release_data = flattened
-
-        recording_data = []
-        for i, text in enumerate(recording_ref):
-            data = recording_ref[text]
-            recording_data.append({ "text": text,
-                                    "id": i, 
-                                    "recording_data": data })
-
-        release_ref = defaultdict(list)
-        for release in release_data:
-            release_ref[release["text"]].append((release["id"], release["score"]))
-            
-        release_data = []
-        for i, text in enumerate(release_ref):
-            release_data.append({ "text": text, "id": i, "release_id_scores": release_ref[text] })
-            
-        recording_index = FuzzyIndex()
-        if recording_data:
+        recording_texts, release_texts, tables = artist_documents(data)
+
+        recording_index = None
+        if recording_texts:
             try:
-                recording_index.build(recording_data, "text")
+                recording_index = FuzzyIndex()
+                recording_index.fit_strings(recording_texts)
             except ValueError:
                 recording_index = None
-        else:
-            recording_index = None
 
-        release_index = FuzzyIndex()
-        if release_data:
+        release_index = None
+        if release_texts:
             try:
-                release_index.build(release_data, "text")
+                release_index = FuzzyIndex()
+                release_index.fit_strings(release_texts)
             except ValueError:
                 release_index = None
-        else:
-            release_index = None
-            
-        # If either the release or the recording index is null, clear out the other data that will
-        # never be used. We return this empty entry to prevent future/build/fail cycles
-        if release_index is None or recording_data is None:
-            recording_data = None
-            release_data = None
-            recording_releases = None
-            release_index = None
-            recording_index = None
-
-        entry = {
-            "recording_index": recording_index,
-            "recording_data": recording_data,
-            "release_index": release_index,
-            "recording_releases": recording_releases,
-            "release_data": release_data
-        }
-        return entry
-
-        
+
+        # If either the release or the recording index is missing, an empty entry is packed. We return
+        # this empty entry to prevent future/build/fail cycles
+        return ArtistData(pack_artist_data(recording_index, release_index, tables))
+
     def load_artist(self, artist_credit_id, write_cache=True):
-        """ Load one artist's release and recordings data from rows/cache/prepared. """
+        """ Load one artist's release and recordings data from the local cache or fetch_artist(). """
+
+        if self.local_cache is None:
+            return self.fetch_artist(artist_credit_id, write_cache)
+
+        # Get the generation first, so that data loaded after an invalidation is never tagged as current
+        t0 = monotonic()
+        generation = self.cache.generation(artist_credit_id)
+        data = self.local_cache.get(artist_credit_id, generation)
+        if data is not None:
+            self.timer.observe(STAGE_ARTIST_LOAD_LOCAL, monotonic() - t0)
+        else:
+            data = self.fetch_artist(artist_credit_id, write_cache)
+            self.local_cache.put(artist_credit_id, data, generation)
+        return data
+
+    def fetch_artist(self, artist_credit_id, write_cache=True):
+        """ Load one artist's release and recordings data from store/cache/rows. """
+
+        # Was it prebuilt by build_indexes.py? Pick up a store that was built or updated since we opened it.
+        t0 = monotonic()
+        store = self.store
+        if store is None or store.replaced():
+            store = self.store = ArtistStore.open(self.index_dir)
+        if store is not None:
+            data = store.get(artist_credit_id)
+            if data is not None:
+                self.timer.observe(STAGE_ARTIST_LOAD_STORE, monotonic() - t0)
+                return data
 
         # Does this artist data live in the shared cache?
         data = self.cache.load(artist_credit_id)
         if data is not None:
+            self.timer.observe(STAGE_ARTIST_LOAD_SHARED, monotonic() - t0)
+            return data
+
+        if not write_cache:
+            data = self.read_artist(artist_credit_id, write_cache)
+            self.timer.observe(STAGE_ARTIST_LOAD_BUILD, monotonic() - t0)
             return data
 
-        # Do we have a build index in the DB?
-        while True:
-            try: 
-                item = IndexCache.get(IndexCache.artist_credit_id == artist_credit_id)
-                data = self.cache.unpickle_data(item.artist_data)
-                if write_cache:
-                    self.cache.save(artist_credit_id, data)
+        # Only one process reads or builds a missing artist, the others wait for it and then find it in the cache
+        with self.cache.building(artist_credit_id):
+            data = self.cache.load(artist_credit_id, count_miss=False)
+            if data is not None:
+                self.timer.observe(STAGE_ARTIST_LOAD_SHARED, monotonic() - t0)
                 return data
-            except OperationalError:
-                sleep(.001)
-                continue
-            except DoesNotExist:
-                break
 
-        # No dice, gotta build this ourselves
+            data = self.read_artist(artist_credit_id, write_cache)
+            self.timer.observe(STAGE_ARTIST_LOAD_BUILD, monotonic() - t0)
+            return data
+
+    def read_artist(self, artist_credit_id, write_cache=True):
+        """ Build one artist's data from its mapping rows and save it to the shared cache. """
+
         index = self.create_artist(artist_credit_id)
         if write_cache:
             self.cache.save(artist_credit_id, index)
         return index
 
-    def search(self, req):
-
-        artist_ids = req["artist_ids"]
-        artist_name = FuzzyIndex.encode_string(req["artist_name"])
-        release_name = FuzzyIndex.encode_string(req["release_name"])
-        recording_name = FuzzyIndex.encode_string(req["recording_name"])
-
-#        print(f"      ids:", artist_ids)
-#        print(f"   artist: {artist_name:<30} {req['artist_name']:<30}")
-#        print(f"  release: {release_name:<30} {req['release_name']:<30}")
-#        print(f"recording: {recording_name:<30} {req['recording_name']:<30}")
-#        print()
-        
-        open_db(self.db_file)
-
-        results = []
-        for artist_id in artist_ids:
-            artist_data = self.load_artist(artist_id)
-            # If the index is None, we've got no data to search, keep going
-            if artist_data is None or artist_data["recording_index"] is None:
+    def search_artist(self, artist_data, queries):
+        """
+            Search one artist's recordings and releases for a list of (release_name, recording_name)
+            queries, encoded. All queries are searched in one batch. Returns a list with a
+            (release_id, recording_id, confidence) tuple or None for each query.
+
+            Without a release name, the hit is the best recording row. With one, it is the best of all
+            recording rows whose release was found too, by the mean of the recording and release confidence.
+        """
+
+        # Without a release only the best recordings (and ties) are needed, with one any recording above the
+        # threshold may be on a release that was found
+        rec_batch = [ None ] * len(queries)
+        with self.timer.time(STAGE_RECORDING_SEARCH):
+            for has_release, limit in ((False, 1), (True, None)):
+                group = [ i for i, (release_name, recording_name) in enumerate(queries) if bool(release_name) == has_release ]
+                if group:
+                    results = artist_data.recording_index.search_arrays([ queries[i][1] for i in group ],
+                                                                        RECORDING_CONFIDENCE, limit=limit)
+                    for i, result in zip(group, results):
+                        rec_batch[i] = result
+        release_names = list({ release_name: None for release_name, recording_name in queries if release_name })
+        rel_batch = {}
+        if release_names:
+            with self.timer.time(STAGE_RELEASE_SEARCH):
+                results = artist_data.release_index.search_arrays(release_names, RELEASE_CONFIDENCE)
+            rel_batch = dict(zip(release_names, results))
+
+        hits = [ None ] * len(queries)
+        for i, (release_name, recording_name) in enumerate(queries):
+            doc_ids, confidences = rec_batch[i]
+            recording_ids, release_ids, scores, docs = artist_data.recording_rows(doc_ids)
+            if not len(recording_ids):
                 continue
 
-            rec_results = artist_data["recording_index"].search(recording_name, min_confidence=RECORDING_CONFIDENCE)
-            exp_results = []
-            for result in rec_results:
-                data = artist_data["recording_data"][result["id"]]
-                for d in data["recording_data"]:
-                    exp_results.append({ "text": result["text"],
-                                         "confidence": result["confidence"],
-                                         "id": d["id"],
-                                         "score": d["score"],
-                                         "release_id": d["release_id"]})
-                    
-            rec_results = sorted(exp_results, key=lambda r: (-r["confidence"], r["score"]))
-                
-#            print("    recording results for '%s'" % recording_name)
-#            print("        rec id   name                     confidence score")
-#            if rec_results:
-#                for res in rec_results:
-#                    if res["confidence"] > .0:
-#                        print("        %-8d %-30s %.2f %d" % (res["id"], res["text"], res["confidence"], res["score"]))
-#            else:
-#                print("    ** No recording results **")
-#            print()
-            
-
+            # Better confidence first, then lower score, then in row order
+            recording_confidences = confidences[docs].astype(np.float64)
             if not release_name:
-                if not rec_results:
-                    continue
-                return (rec_results[0]["release_id"], rec_results[0]["id"], rec_results[0]["confidence"])
-
-            rel_results = artist_data["release_index"].search(release_name, min_confidence=RELEASE_CONFIDENCE)
-            exp_results = []
-            for result in rel_results:
-                data = artist_data["release_data"][result["id"]]
-                for release_id, score in data["release_id_scores"]:
-                    exp_results.append({ "text": result["text"],
-                                         "confidence": result["confidence"],
-                                         "id": release_id,
-                                         "score": score })
-
-            rel_results = sorted(exp_results, key=lambda r: (-r["confidence"], r["score"]))
-#           print("    release results for '%s'" % release_name)
-#           if rel_results:
-#               print("        rel id   name                     confidence")
-#               for res in rel_results:
-#                   if res["confidence"] > .0:
-#                       print("        %-8d %-30s %.2f" % (res["id"], res["text"], res["confidence"]))
-#               print()
-#           else:
-#               print("    ** No release results **")
-
-
-            RESULT_THRESHOLD = .7
-            hits = []
-            for rec_res in rec_results[:3]:
-#                if rec_res["confidence"] < RESULT_THRESHOLD:
-#                    break
-                for rel_res in rel_results[:3]:
-#                    if rel_res["confidence"] < RESULT_THRESHOLD:
-#                        break
-                    if rec_res["id"] in artist_data["recording_releases"]:
-                        hits.append({ "recording_id": rec_res["id"],
-                                      "recording_text": rec_res["text"],
-                                      "recording_conf": rec_res["confidence"],
-                                      "score": rec_res["score"],
-                                      "release_id": rel_res["id"],
-                                      "release_name": rel_res["text"],
-                                      "release_conf": rel_res["confidence"],
-                                      "confidence": (rec_res["confidence"] + rel_res["confidence"])/2 })
-                       
-            if not hits:
+                best = np.lexsort((scores, -recording_confidences))[0]
+                hits[i] = (int(release_ids[best]), int(recording_ids[best]), float(recording_confidences[best]))
+                continue
+
+            # The best confidence of each release that was found
+            rel_doc_ids, rel_confidences = rel_batch[release_name]
+            found_ids, found_scores, found_docs = artist_data.release_rows(rel_doc_ids)
+            found_confidences = rel_confidences[found_docs].astype(np.float64)
+            order = np.lexsort((-found_confidences, found_ids))
+            found_ids, found_confidences = found_ids[order], found_confidences[order]
+            first = np.ones(len(found_ids), dtype=bool)
+            first[1:] = found_ids[1:] != found_ids[:-1]
+            found_ids, found_confidences = found_ids[first], found_confidences[first]
+
+            # Join the recording rows with the releases found on their release id
+            positions = np.minimum(np.searchsorted(found_ids, release_ids), len(found_ids) - 1)
+            rows = np.flatnonzero(found_ids[positions] == release_ids) if len(found_ids) else positions[:0]
+            if not len(rows):
                 continue
-                        
-#            print("    combined results for '%s'" % release_name)
-#            hits = sorted(hits, key=lambda h: h["confidence"], reverse=True)
-#            if hits:
-#                print("        rec id   name                     confidence score    rel id   name                conf")
-#                for hit in hits:
-#                    print("        %-8d %-30s %.2f %-8d %-8d %-30s %.2f -> %.2f" % (hit["recording_id"],
-#                                                             hit["recording_text"],
-#                                                             hit["recording_conf"],
-#                                                             hit["score"],
-#                                                             hit["release_id"],
-#                                                             hit["release_name"],
-#                                                             hit["release_conf"],
-#                                                             hit["confidence"]
-#                                                              ))
-#                print()
-#            else:
-#                print("    ** No hits **")
-
-            return (hits[0]["release_id"], hits[0]["recording_id"], hits[0]["confidence"])
-
-        return None
+
+            matches = (recording_confidences[rows] + found_confidences[positions[rows]]) / 2
+            best = np.lexsort((scores[rows], -matches))[0]
+            hits[i] = (int(release_ids[rows[best]]), int(recording_ids[rows[best]]), float(matches[best]))
+
+        return hits
+
+    def search(self, req):
+        """ Search for a single request, returns (release_id, recording_id, confidence) or None """
+
+        return self.search_batch([req])[0]
+
+    def search_batch(self, reqs):
+        """
+            Search for a list of requests. Each request walks its candidate artist_ids in order until one
+            of them has a hit. Requests are grouped by their current candidate artists, so each artist is loaded
+            at most once per batch and searched once per round for all requests that currently point at it.
+
+            With a fan_out > 1, each round looks at the next fan_out candidates of every request and loads and
+            searches those artists in parallel. A request still gets the hit of its first candidate that has
+            one, but no longer waits for candidates further down once that is known.
+        """
+
+        queries = list(zip(FuzzyIndex.encode_strings([ req["release_name"] for req in reqs ]),
+                           FuzzyIndex.encode_strings([ req["recording_name"] for req in reqs ])))
+        results = [ None ] * len(reqs)
+        positions = [ 0 ] * len(reqs)
+        pending = [ i for i, req in enumerate(reqs) if req["artist_ids"] ]
+        loaded = {}
+        while pending:
+            windows = {}
+            groups = defaultdict(list)
+            for i in pending:
+                windows[i] = list(dict.fromkeys(reqs[i]["artist_ids"][positions[i]:positions[i] + self.fan_out]))
+                for artist_id in windows[i]:
+                    groups[artist_id].append(i)
+
+            if self.fan_out > 1:
+                hits = self.search_candidates_parallel(groups, windows, queries, loaded)
+            else:
+                hits = { artist_id: dict(zip(group, self.search_candidates(artist_id, group, queries, loaded)))
+                         for artist_id, group in groups.items() }
+
+            pending = []
+            for i, window in windows.items():
+                for artist_id in window:
+                    hit = hits.get(artist_id, {}).get(i)
+                    if hit is not None:
+                        results[i] = hit
+                        break
+                else:
+                    positions[i] += self.fan_out
+                    if positions[i] < len(reqs[i]["artist_ids"]):
+                        pending.append(i)
+
+        return results
+
+    def search_candidates(self, artist_id, group, queries, loaded):
+        """ Load an artist and search it for the queries of the requests in group, returns their hits """
+
+        if artist_id not in loaded:
+            global_index = self.global_index
+            if global_index is not None:
+                if global_index.replaced():
+                    global_index = self.global_index = global_index.reopen()
+                with self.timer.time(STAGE_ARTIST_LOAD_GLOBAL):
+                    loaded[artist_id] = global_index.artist(artist_id)
+            else:
+                loaded[artist_id] = self.load_artist(artist_id)
+        artist_data = loaded[artist_id]
+
+        # If the index is None, we've got no data to search, keep going
+        if artist_data is None or artist_data.is_empty:
+            return [ None ] * len(group)
+
+        return self.search_artist(artist_data, [ queries[i] for i in group ])
+
+    def search_candidates_parallel(self, groups, windows, queries, loaded):
+        """
+            search_candidates() for all groups on the thread pool. Returns as soon as the first hit of every
+            request in windows is known, the searches that are no longer needed are cancelled.
+        """
+
+        pool = search_executor(self.fan_out)
+        futures = { pool.submit(self.search_candidates, artist_id, group, queries, loaded): artist_id
+                    for artist_id, group in groups.items() }
+        hits = {}
+        undecided = set(windows)
+        not_done = set(futures)
+        while not_done and undecided:
+            done, not_done = concurrent.futures.wait(not_done, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                artist_id = futures[future]
+                hits[artist_id] = dict(zip(groups[artist_id], future.result()))
+            undecided = { i for i in undecided if not self.first_hit_known(windows[i], hits, i) }
+
+        for future in not_done:
+            future.cancel()
+
+        return hits
+
+    def first_hit_known(self, window, hits, i):
+        """ Return True if request i has a hit in window and all candidates before it have been searched """
+
+        for artist_id in window:
+            if artist_id not in hits:
+                return False
+            if hits[artist_id][i] is not None:
+                return True
+
+        return True
@@ -1,19 +1,10 @@
 import atexit
-from time import monotonic, sleep
-from multiprocessing import Process, Queue
-from multiprocessing.queues import Empty
+from multiprocessing import Process
 import os
-from uuid import uuid4
+import threading
 
-from flask import Flask, request, jsonify, render_template, redirect
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, render_template, redirect
 from werkzeug.exceptions import BadRequest, ServiceUnavailable, NotFound, InternalServerError
-from lb_matching_tools.cleaner import MetadataCleaner
-from playhouse.shortcuts import model_to_dict
-
-from database import open_db, Mapping
-from search_index import MappingLookupSearch
-from fuzzy_index import FuzzyIndex
-from shared_mem_cache import SharedMemoryArtistDataCache, start_manager_thread
 
 
 INDEX_DIR = "index"
@@ -22,132 +13,143 @@ INDEX_DIR = "index"
 # sudo mount -o size=100M -t tmpfs none /mnt/tmpfs
 # mount -o remount,size=75G /dev/shm
 TEMP_DIR = "/mnt/tmpfs"
-SHORT_ARTIST_LENGTH = 5
-SHORT_ARTIST_CONFIDENCE = .5
-NORMAL_ARTIST_CONFIDENCE = .7
-
-# If the search hit is less than this, clean metadata and search those too!
-CLEANER_CONFIDENCE = .9
 
 SEARCH_TIMEOUT = 10 # in seconds
 
-cache = SharedMemoryArtistDataCache(TEMP_DIR, max_cache_size=1024 * 1024 * 1024 * 2)
-ms = MappingLookupSearch(cache, INDEX_DIR)
-
-p = Process(target=start_manager_thread, args=[cache])
-p.start()
-
-artist_index = FuzzyIndex("artist_index")
-artist_index.load(INDEX_DIR)
-
-stupid_artist_index = FuzzyIndex("stupid_artist_index")
-if not stupid_artist_index.load(INDEX_DIR):
-    stupid_artist_index = None
-
-db_file = os.path.join(INDEX_DIR, "mapping.db")
-app = Flask(__name__, template_folder = "templates")
-
-def cleanup():
-    assert False
-    cache.stop_process()
-    cache.clear_cache()
-
-try:
-    import uwsgi
-    uwsgi.atexit = cleanup
-except ImportError:
-    atexit.register(cleanup)
+# How long a request waits for a process that is still loading its indexes
+STARTUP_TIMEOUT = 60 # in seconds
+
+# The maximum number of queries in one /1/search_batch request
+MAX_BATCH_SIZE = 1000
+
+CACHE_SIZE = 1024 * 1024 * 1024 * 2
+
+# Size of each process' own cache of ready to search artist data, in front of the shared memory cache
+LOCAL_CACHE_SIZE = 1024 * 1024 * 128
+
+# How many candidate artists of a query to load and search at the same time
+SEARCH_FAN_OUT = 4
+
+
+class SearchState:
+    """
+        The caches, indexes and lookup of one server process. They are loaded by a background thread
+        that start() begins, so that a process answers /ready at once and only search requests wait for
+        the indexes. The search modules (numpy, scipy, peewee, the matching tools) are imported by that
+        thread too, not when the server module is imported.
+    """
+
+    def __init__(self, index_dir, temp_dir):
+        self.index_dir = index_dir
+        self.temp_dir = temp_dir
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.pid = None
+        self.error = None
+        self.cache = None
+        self.metrics = None
+        self.lookup = None
+
+    def start(self):
+        """ Start loading in the background, unless this process has loaded or is loading already """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # A forked process keeps what its parent loaded, but not the thread that was still loading
+            if self.ready.is_set() and self.error is None:
+                return
+            self.ready = threading.Event()
+            self.error = None
+            threading.Thread(target=self.load, args=(self.ready,), daemon=True).start()
+
+    def load(self, ready):
+        try:
+            from artist_resolution_cache import ArtistResolutionCache
+            from global_index import GlobalIndex
+            from mapping_lookup import MappingLookup
+            from search_index import MappingLookupSearch
+            from shared_mem_cache import SharedMemoryArtistDataCache
+            from shared_metrics import SharedMetrics
+
+            # Stage times and counters of all server processes, see /metrics
+            self.metrics = SharedMetrics()
+            self.cache = SharedMemoryArtistDataCache(self.temp_dir, max_cache_size=CACHE_SIZE, timer=self.metrics)
+            # If global_index.py has built the global recording/release index, search that instead of per-artist indexes
+            ms = MappingLookupSearch(self.cache, self.index_dir, global_index=GlobalIndex.open(self.index_dir),
+                                     local_cache_size=LOCAL_CACHE_SIZE, fan_out=SEARCH_FAN_OUT, timer=self.metrics)
+            # Artist names resolved by any server process. Warm it with artist_resolution_cache.py.
+            resolution_cache = ArtistResolutionCache()
+            self.lookup = MappingLookup(self.index_dir, ms, timer=self.metrics, resolution_cache=resolution_cache)
+        except Exception as err:
+            print("Cannot load the search indexes: %s" % err)
+            self.error = err
+        finally:
+            ready.set()
+
+    def get(self):
+        """ Return the loaded state, after waiting for it if the process is still loading """
+        self.start()
+        if not self.ready.wait(STARTUP_TIMEOUT) or self.error is not None:
+            raise ServiceUnavailable("The search indexes are not loaded")
+
+        return self
+
+
+def create_app(index_dir=INDEX_DIR, temp_dir=TEMP_DIR, start_manager=True):
+    """
+        Create the search app. Its indexes are loaded in the background, in each server process, see
+        SearchState. With start_manager, the process that maintains the shared artist cache is started.
+    """
+
+    app = Flask(__name__, template_folder = "templates")
+    app.register_blueprint(bp)
+    state = SearchState(index_dir, temp_dir)
+    app.extensions["search_state"] = state
+
+    if start_manager:
+        from shared_mem_cache import SharedMemoryArtistDataCache, start_manager_thread
+
+        cache = SharedMemoryArtistDataCache(temp_dir, max_cache_size=CACHE_SIZE)
+        p = Process(target=start_manager_thread, args=[cache])
+        p.start()
+
+        def cleanup():
+            assert False
+            cache.stop_process()
+            cache.clear_cache()
+    else:
+        cleanup = None
 
-def mapping_search(artist, release, recording):
+    try:
+        import uwsgi
+        if cleanup is not None:
+            uwsgi.atexit = cleanup
+        # uWSGI imports the app before it forks the workers, load in each worker
+        uwsgi.post_fork_hook = state.start
+    except ImportError:
+        if cleanup is not None:
+            atexit.register(cleanup)
+        state.start()
 
-    mc = MetadataCleaner()
-    encoded_artist = artist_index.encode_string(artist)
-    
-    open_db(db_file)
+    return app
 
-    # Is this a normal (not stupid) artist?
-    if encoded_artist:
-        if len(encoded_artist) <= SHORT_ARTIST_LENGTH:
-            confidence = SHORT_ARTIST_CONFIDENCE
-        else:
-            confidence = NORMAL_ARTIST_CONFIDENCE
 
-        # Do a normal artist search
-        artists = artist_index.search(encoded_artist, min_confidence=confidence)
-        try:
-            max_confidence = max([ a["confidence"] for a in artists ])
-        except ValueError:
-            max_confidence = 0.0
+def search_state():
+    return current_app.extensions["search_state"].get()
 
-        if max_confidence <= CLEANER_CONFIDENCE:
-            cleaned_artist = artist_index.encode_string(mc.clean_artist(artist))
-            if cleaned_artist != encoded_artist:
-                artists.extend(artist_index.search(cleaned_artist, min_confidence=confidence))
 
-        if not artists:
-            raise NotFound("Artist '%s' was not found." % artist)
+bp = Blueprint("search", __name__)
 
-        artists = sorted(artists, key=lambda a: a["confidence"], reverse=True)
-        # Collect the artist ids
-        ids = [ a["id"] for a in artists ]
-
-    else:
-        # If the name contains no word characters (stoopid), search the stupid artists
-        if stupid_artist_index:
-            encoded = FuzzyIndex.encode_string_for_stupid_artists(artist)
-            artists = stupid_artist_index.search(encoded, min_confidence=NORMAL_ARTIST_CONFIDENCE)
-            ids = [ a["id"] for a in artists ]
-        else:
-            return jsonify({})
-
-    if not ids:
-        raise NotFound("Artist '%s' was not found." % artist)
-
-    conf_index = { a["id"]:a["confidence"] for a in artists }
-    # Make the search request
-    req = {
-        "artist_ids": ids,
-        "artist_name": artist,
-        "release_name": release,
-        "recording_name": recording,
-        "id": str(uuid4())
-    }
-
-    t0 = monotonic() 
-    resp = ms.search(req)
-    duration = monotonic() - t0
-    if resp is None:
-        raise NotFound("Not found")
-
-    release_id, recording_id, r_conf = resp
-    results = []
-    data = Mapping.select().where((Mapping.release_id == release_id) & (Mapping.recording_id == recording_id))
-    for row in data:
-        d = model_to_dict(row)
-        del d["score"]
-        d["r_conf"] = r_conf
-        d["time"] = "%.1fms" % (duration * 1000)
-        # TODO: Investigate this exception
-        try:
-            d["a_conf"] = conf_index[d["artist_credit_id"]]
-        except KeyError:
-            d["a_conf"] = -1
-        del d["artist_credit_id"]
-        del d["recording_id"]
-        del d["release_id"]
-        results.append(d)
-        
-    return results
-
-@app.route("/")
+@bp.route("/")
 def index():
     return redirect("/search")
 
-@app.route("/search", methods=["GET"])
+@bp.route("/search", methods=["GET"])
 def search():
     return render_template("index.html")
 
-@app.route("/search", methods=["POST"])
+@bp.route("/search", methods=["POST"])
 def search_post():
     artist = request.form.get("artist", "")
     release = request.form.get("release", "")
@@ -155,12 +157,12 @@ def search_post():
     if not artist or not recording:
         raise BadRequest("artist and recording must be given")
 
-    return render_template("index.html", results=mapping_search(artist, release, recording),
+    return render_template("index.html", results=search_state().lookup.mapping_search(artist, release, recording),
                                          artist=artist,
                                          release=release,
                                          recording=recording)
 
-@app.route("/1/search")
+@bp.route("/1/search")
 def api_search():
     artist = request.args.get("a", "")
     release = request.args.get("rl", "")
@@ -168,4 +170,35 @@ def api_search():
     if not artist or not recording:
         raise BadRequest("a and rc must be given")
 
-    return jsonify(mapping_search(artist, release, recording))
\ No newline at end of file
+    return jsonify(search_state().lookup.mapping_search(artist, release, recording))
+
+@bp.route("/1/search_batch", methods=["POST"])
+def api_search_batch():
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list):
+        raise BadRequest("A JSON list of [artist, release, recording] queries must be posted")
+    if len(queries) > MAX_BATCH_SIZE:
+        raise BadRequest("At most %d queries can be searched in one batch" % MAX_BATCH_SIZE)
+
+    for query in queries:
+        if not isinstance(query, list) or len(query) != 3 or not all(isinstance(q, str) for q in query):
+            raise BadRequest("Each query must be a list of [artist, release, recording] strings")
+        if not query[0] or not query[2]:
+            raise BadRequest("artist and recording must be given")
+
+    return jsonify(search_state().lookup.mapping_search_batch(queries))
+
+@bp.route("/metrics")
+def api_metrics():
+    state = search_state()
+    return Response(state.metrics.prometheus(state.cache.stats()), mimetype="text/plain; version=0.0.4")
+
+@bp.route("/ready")
+def api_ready():
+    """ 200 once this process has loaded its indexes, 503 while it is loading or if it failed to """
+    state = current_app.extensions["search_state"]
+    state.start()
+    if not state.ready.is_set() or state.error is not None:
+        raise ServiceUnavailable("The search indexes are not loaded")
+
+    return jsonify({ "ready": True })
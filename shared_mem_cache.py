@@ -1,131 +1,380 @@
+from contextlib import contextmanager
 from time import monotonic, sleep
 from multiprocessing import shared_memory
+import fcntl
 import glob
-import pickle
+import mmap
 import os
+import struct
 import sys
+import threading
 
-from cache import ArtistDataCache
-from fuzzy_index import FuzzyIndex
+import numpy as np
+
+from artist_data import ArtistData
+from stage_timer import StageTimer, COUNTER_ARTIST_CACHE_HITS, COUNTER_ARTIST_CACHE_MISSES
+
+# Where the shared memory segments live
+SHM_DIR = "/dev/shm"
+# All segments and files of the cache start with this, so that we never touch anyone else's segments
+NAMESPACE = "ff_"
+# How often the manager reports the counters and removes segments left behind by crashed processes
+MANAGER_INTERVAL = 30  # in seconds
+
+# The metadata table is an open addressing hash table of NUM_SLOTS slots, keyed by artist_id + 1 so that
+# zeroed memory is an empty table. It is never filled more than MAX_ENTRIES, to keep probe sequences short.
+NUM_SLOTS = 1 << 17
+MAX_ENTRIES = NUM_SLOTS * 3 // 4
+SLOT_KEY, SLOT_SIZE, SLOT_REFERENCED = range(3)
+SLOT_FIELDS = 3
+
+# Table header: clock hand, the current size and number of entries and the number of evictions. Hits and
+# misses are counted by each process, see load().
+HEADER_HAND, HEADER_BYTES, HEADER_ENTRIES, HEADER_EVICTIONS = range(4)
+HEADER_FIELDS = 8
+
+# After the table, generation counters: invalidating an artist increments the counter of its bucket, which
+# tells processes to drop copies of the artist's data they keep themselves.
+NUM_GENERATIONS = 1 << 16
+
+# Builds of missing entries are serialized per artist by locking one byte of the build lock file. Artists
+# share NUM_BUILD_LOCKS bytes, so that the number of locks doesn't grow with the number of artists.
+NUM_BUILD_LOCKS = 4096
+
+# struct flock for fcntl(F_OFD_SETLKW): type, whence, start, length and the pid, which must be 0
+FLOCK = struct.Struct("hhqqi4x")
 
-# How much to reduce the cached data by when it gets near the limit
-CACHE_PURGE_SIZE_REDUCTION = 10  # in %
-# When to start reducing the in memory cache
-CACHE_PURGE_THRESHOLD = 90  # in %
 
 def start_manager_thread(obj):
     obj.cache_manager_thread()
 
-class SharedMemoryArtistDataCache(ArtistDataCache):
-    """class for caching data using shared memory"""
+def lock_range(fd, lock_type, start=0, length=0):
+    """
+        Take (fcntl.F_WRLCK) or release (fcntl.F_UNLCK) a lock on a byte range of a file, waiting for it.
+        These are open file description locks: unlike lockf() locks they are not owned by the process, so
+        the kernel doesn't fail a wait with EDEADLK because another thread of the waiting process holds a
+        lock that the holder is waiting for. Threads that lock through the same descriptor are not excluded
+        from each other, and neither are processes that inherited the descriptor.
+    """
+    fcntl.fcntl(fd, fcntl.F_OFD_SETLKW, FLOCK.pack(lock_type, os.SEEK_SET, start, length, 0))
+
+class SharedMemoryArtistDataCache:
+    """
+        class for caching data using shared memory. Each artist's packed data is kept in its own segment and
+        a metadata table in another segment tracks the size of each segment and a CLOCK reference bit. When
+        saving an entry would take the cache over max_cache_size bytes, entries that have not been loaded
+        since the clock hand last passed them are evicted first.
 
-    def __init__(self, temp_dir, max_cache_size):
+        The table is shared by all processes using the same namespace. Changes to it are guarded by a lock
+        file, loads only read it. Hits and misses are counted by each process and reported to the StageTimer
+        timer, which sums them over all processes if it is a SharedMetrics.
+    """
+
+    def __init__(self, temp_dir, max_cache_size, namespace=NAMESPACE, timer=None):
         self.temp_dir = temp_dir
         self.exit = False
         self.max_cache_size = max_cache_size
-        
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.fds_lock = threading.Lock()
+        self.fds = {}
+        self.fds_pid = None
+        self.build_locks = [ threading.Lock() for i in range(NUM_BUILD_LOCKS) ]
+        self.meta = None
+        self.header = None
+        self.slots = None
+        self.generations = None
+        self.timer = timer or StageTimer()
+        self.counts_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
     def stop_process(self):
         self.exit = True
-        
-    def pickle_data(self, artist_data):
-        if artist_data is None or artist_data["release_index"] is None or artist_data["recording_index"] is None:
-            return pickle.dumps("[empty]")
-
-        prepared = {
-            "recording_data": artist_data["recording_data"],
-            "recording_releases": artist_data["recording_releases"],
-            "release_data": artist_data["release_data"],
-            "release_index": artist_data["release_index"].save_to_mem(self.temp_dir) if artist_data is not None else None,
-            "recording_index": artist_data["recording_index"].save_to_mem(self.temp_dir) if artist_data is not None else None
-        }
-        return pickle.dumps(prepared)
-        
-    def save(self, artist_id, artist_data):
-        if self.max_cache_size == 0:
-            return
 
-        pickled = self.pickle_data(artist_data)
-        p_len = len(pickled)
+    def segment_name(self, artist_id):
+        return f"{self.namespace}a{artist_id}"
+
+    def lock_file(self, name):
+        """
+            Return this process' descriptor of a lock file. A forked process opens the file again: locks
+            taken through the descriptor it inherited would be shared with its parent, see lock_range().
+        """
+        with self.fds_lock:
+            if self.fds_pid != os.getpid():
+                for fd in self.fds.values():
+                    os.close(fd)
+                self.fds = {}
+                self.fds_pid = os.getpid()
+            if name not in self.fds:
+                self.fds[name] = os.open(os.path.join(SHM_DIR, self.namespace + name), os.O_RDWR | os.O_CREAT, 0o600)
+            return self.fds[name]
+
+    @contextmanager
+    def locked(self):
+        """ Lock the metadata table against other threads and processes, attaching to it first if needed """
+        # The file lock doesn't exclude threads of the same process, the thread lock does
+        with self.lock:
+            fd = self.lock_file("lock")
+            lock_range(fd, fcntl.F_WRLCK)
+            try:
+                if self.slots is None:
+                    self.attach()
+                yield
+            finally:
+                lock_range(fd, fcntl.F_UNLCK)
+
+    @contextmanager
+    def building(self, artist_id):
+        """
+            Let only one thread of all processes at a time load or build a missing artist entry. The others
+            wait here until it is done and can then load the entry from the cache.
+        """
+        stripe = artist_id % NUM_BUILD_LOCKS
+        # The file lock doesn't exclude threads of the same process, the thread lock does
+        with self.build_locks[stripe]:
+            fd = self.lock_file("build.lock")
+            lock_range(fd, fcntl.F_WRLCK, stripe, 1)
+            try:
+                yield
+            finally:
+                lock_range(fd, fcntl.F_UNLCK, stripe, 1)
+
+    def attach(self):
+        """ Open the metadata table, creating it if this is the first process to use it. Call with the lock held. """
+        size = (HEADER_FIELDS + NUM_SLOTS * SLOT_FIELDS + NUM_GENERATIONS) * 8
         try:
-            shm = shared_memory.SharedMemory(name=f"a{artist_id}", create=True, size=p_len, track=False)
-            shm.buf[:p_len] = bytearray(pickled)
+            self.meta = shared_memory.SharedMemory(name=self.namespace + "meta", create=True, size=size, track=False)
         except FileExistsError:
+            self.meta = shared_memory.SharedMemory(name=self.namespace + "meta", create=False, track=False)
+        self.header = np.ndarray(HEADER_FIELDS, dtype=np.int64, buffer=self.meta.buf)
+        self.slots = np.ndarray((NUM_SLOTS, SLOT_FIELDS), dtype=np.int64, buffer=self.meta.buf, offset=HEADER_FIELDS * 8)
+        self.generations = np.ndarray(NUM_GENERATIONS, dtype=np.int64, buffer=self.meta.buf,
+                                      offset=(HEADER_FIELDS + NUM_SLOTS * SLOT_FIELDS) * 8)
+
+    def home(self, key):
+        """ Return the first slot to probe for a key (Fibonacci hashing) """
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - NUM_SLOTS.bit_length() + 1)
+
+    def find(self, artist_id):
+        """ Return the slot of an artist, or -1 if it is not in the table """
+        key = artist_id + 1
+        i = self.home(key)
+        while True:
+            slot_key = self.slots[i, SLOT_KEY]
+            if slot_key == key:
+                return i
+            if slot_key == 0:
+                return -1
+            i = (i + 1) % NUM_SLOTS
+
+    def insert(self, artist_id, size):
+        i = self.home(artist_id + 1)
+        while self.slots[i, SLOT_KEY] != 0:
+            i = (i + 1) % NUM_SLOTS
+        self.slots[i] = (artist_id + 1, size, 1)
+        self.header[HEADER_BYTES] += size
+        self.header[HEADER_ENTRIES] += 1
+
+    def remove(self, i):
+        """ Remove the entry in slot i from the table, moving later entries of its probe sequence back """
+        self.header[HEADER_BYTES] -= self.slots[i, SLOT_SIZE]
+        self.header[HEADER_ENTRIES] -= 1
+        j = i
+        while True:
+            self.slots[i] = 0
+            while True:
+                j = (j + 1) % NUM_SLOTS
+                key = self.slots[j, SLOT_KEY]
+                if key == 0:
+                    return
+                # The entry in j can fill the hole in i only if its home slot is not in (i, j]
+                k = self.home(int(key))
+                if (i < j and (k <= i or k > j)) or (i > j and k <= i and k > j):
+                    break
+            self.slots[i] = self.slots[j]
+            i = j
+
+    def unlink(self, artist_id):
+        try:
+            os.unlink(os.path.join(SHM_DIR, self.segment_name(artist_id)))
+        except FileNotFoundError:
             pass
-        except TypeError:
-            print(artist_data)
-            print("p: '%s'" % pickled)
-            print("plen: '%s'" % p_len)
-        
-    def load(self, artist_id):
+
+    def evict_one(self):
+        """
+            Evict the entry the clock hand points at next, skipping (and clearing the reference bit of)
+            entries that were used since the hand last passed them. Returns False if the table is empty.
+        """
+        keys = self.slots[:, SLOT_KEY]
+        referenced = self.slots[:, SLOT_REFERENCED]
+        hand = int(self.header[HEADER_HAND])
+        # Two laps: after the first one all reference bits are cleared
+        for start, end in ((hand, NUM_SLOTS), (0, hand), (hand, NUM_SLOTS), (0, hand)):
+            candidates = np.flatnonzero((keys[start:end] != 0) & (referenced[start:end] == 0))
+            if len(candidates) == 0:
+                referenced[start:end] = 0
+                continue
+
+            i = start + int(candidates[0])
+            referenced[start:i] = 0
+            self.unlink(int(keys[i]) - 1)
+            self.remove(i)
+            self.header[HEADER_EVICTIONS] += 1
+            self.header[HEADER_HAND] = (i + 1) % NUM_SLOTS
+            return True
+
+        return False
+
+    def save(self, artist_id, artist_data):
+        if self.max_cache_size == 0:
+            return
+
+        packed = artist_data.buffer
+        size = len(packed)
+        if size > self.max_cache_size:
+            return
+
+        with self.locked():
+            if self.find(artist_id) >= 0:
+                # Another process saved it first
+                return
+
+            while self.header[HEADER_BYTES] + size > self.max_cache_size or self.header[HEADER_ENTRIES] >= MAX_ENTRIES:
+                if not self.evict_one():
+                    break
+
+            try:
+                shm = shared_memory.SharedMemory(name=self.segment_name(artist_id), create=True, size=size, track=False)
+            except FileExistsError:
+                # Not in the table, so left behind by a crashed process
+                self.unlink(artist_id)
+                shm = shared_memory.SharedMemory(name=self.segment_name(artist_id), create=True, size=size, track=False)
+            self.insert(artist_id, size)
+
+        # Write the magic last, so that readers never query a partially written entry
+        shm.buf[4:size] = packed[4:]
+        shm.buf[:4] = packed[:4]
+        shm.close()
+
+    def load(self, artist_id, count_miss=True):
+        """
+            Map the artist's segment read-only and query it in place, without copying or unpickling it.
+            Pass count_miss=False to check again for an entry whose miss has already been counted.
+        """
+        data = self.map_segment(artist_id)
+        if data is None:
+            if count_miss:
+                with self.counts_lock:
+                    self.misses += 1
+                self.timer.count(COUNTER_ARTIST_CACHE_MISSES)
+            return None
+
+        with self.counts_lock:
+            self.hits += 1
+        self.timer.count(COUNTER_ARTIST_CACHE_HITS)
+
+        if self.slots is None:
+            with self.locked():
+                pass
+        # The reference bit is only a hint for evict_one(), so it is set without the lock. If another process
+        # moves entries at the same time, find() can miss the entry or the bit can land on another entry,
+        # which only makes the next eviction less accurate.
+        i = self.find(artist_id)
+        if i >= 0:
+            self.slots[i, SLOT_REFERENCED] = 1
+
+        return data
+
+    def map_segment(self, artist_id):
         try:
-            shm = shared_memory.SharedMemory(name=f"a{artist_id}", create=False, track=False)
+            fd = os.open(os.path.join(SHM_DIR, self.segment_name(artist_id)), os.O_RDONLY)
         except FileNotFoundError:
             return None
 
-        return self.unpickle_data(shm.buf)
-    
-    def unpickle_data(self, data):
-
-        pickled = pickle.loads(data)
-        if pickled == "[empty]":
-            return {
-                "recording_data": None,
-                "recording_releases": None,
-                "release_data": None,
-                "release_index": None,
-                "recording_index": None,
-            }
-        fi = FuzzyIndex()
-        fi.load_from_mem(pickled["release_index"], self.temp_dir)
-        pickled["release_index"] = fi
-        fi = FuzzyIndex()
-        fi.load_from_mem(pickled["recording_index"], self.temp_dir)
-        pickled["recording_index"] = fi 
-        
-        return pickled
-    
+        try:
+            buf = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        except ValueError:
+            # The segment was created, but not yet sized by the process saving it
+            return None
+        finally:
+            os.close(fd)
+
+        try:
+            return ArtistData(buf)
+        except (ValueError, struct.error):
+            # Not (yet) completely written, treat as a miss
+            return None
+
+    def invalidate(self, artist_id):
+        """
+            Remove an artist's segment, so that the next load fetches its current data. Processes that
+            still have the old segment mapped keep using it until they drop it.
+        """
+        with self.locked():
+            i = self.find(artist_id)
+            if i >= 0:
+                self.remove(i)
+            self.unlink(artist_id)
+            self.generations[artist_id % NUM_GENERATIONS] += 1
+
+    def generation(self, artist_id):
+        """ Return the generation of an artist's data, which changes whenever the artist is invalidated """
+        if self.generations is None:
+            with self.locked():
+                pass
+        # A single aligned int64, no need to lock for reading it
+        return int(self.generations[artist_id % NUM_GENERATIONS])
+
+    def stats(self):
+        """ Return the cache counters and current size. The hits and misses are those of this process. """
+        with self.locked():
+            return { "hits": self.hits,
+                     "misses": self.misses,
+                     "evictions": int(self.header[HEADER_EVICTIONS]),
+                     "entries": int(self.header[HEADER_ENTRIES]),
+                     "bytes": int(self.header[HEADER_BYTES]),
+                     "max_bytes": self.max_cache_size }
+
+    def segment_files(self):
+        return glob.glob(os.path.join(SHM_DIR, self.namespace + "a*"))
+
+    def remove_orphans(self):
+        """
+            Remove segments that are not in the table. Entries are added to the table before their
+            segment is created, so these were left behind by crashed processes.
+        """
+        removed = 0
+        with self.locked():
+            for filename in self.segment_files():
+                try:
+                    artist_id = int(os.path.basename(filename)[len(self.namespace) + 1:])
+                except ValueError:
+                    continue
+                if self.find(artist_id) < 0:
+                    self.unlink(artist_id)
+                    removed += 1
+
+        return removed
+
     def clear_cache(self):
         print("clear artist cache")
-        for f in os.listdir("/dev/shm"):
-            filename = os.path.basename(f)
-            try:
-                shm = shared_memory.SharedMemory(name=filename, create=False, track=False)
-            except OSError as err:
-                print("Cannot removed shared memory block %s:" % filename, str(err))
-                continue
-            shm.close()
-            shm.unlink()
-
-    def cache_manager_thread(self):
-        while not self.exit:
-            # run the cache check once a minute
-            sleep(30)
-
-            index = {}
-            files = list(filter(os.path.isfile, glob.glob("/dev/shm/" + "*")))
-            for filename in files:
-                try:    
-                    index[filename] = (os.path.getsize(filename), os.path.getatime(filename))
+        with self.locked():
+            for filename in self.segment_files():
+                try:
+                    os.unlink(filename)
                 except FileNotFoundError:
                     pass
+            self.slots[:] = 0
+            self.header[:] = 0
+            self.generations += 1
 
-            total_size = sum([ index[x][0] for x in index ])
-            if total_size < (self.max_cache_size * CACHE_PURGE_THRESHOLD / 100):
-                print("not cleaning cache: %d < %d" % (total_size, (self.max_cache_size * CACHE_PURGE_THRESHOLD / 100)))
-                continue
+    def cache_manager_thread(self):
+        """ Entries are evicted as they are saved, this only reports the counters and cleans up after crashes """
+        while not self.exit:
+            sleep(MANAGER_INTERVAL)
 
-            target_size = self.max_cache_size * CACHE_PURGE_SIZE_REDUCTION / 100
-            print("target size: %d total size: %d" %(target_size, total_size)) 
-            for filename in sorted(files, key=lambda x: index[x][1]):
-                base = os.path.basename(filename)
-                try:
-                    shm = shared_memory.SharedMemory(name=base, create=False, track=False)
-                except OSError as err:
-                    print("Cannot removed shared memory block %s:" % base, str(err))
-                    continue
-                shm.close()
-                shm.unlink()
-                
-                total_size -= index[filename][0]
-                if total_size < target_size:
-                    break
+            removed = self.remove_orphans()
+            stats = self.stats()
+            print("artist cache: %d entries, %d of %d bytes, %d evictions, %d orphans removed" %
+                  (stats["entries"], stats["bytes"], stats["max_bytes"], stats["evictions"], removed))
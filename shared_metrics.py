@@ -0,0 +1,171 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import fcntl
+import os
+import threading
+
+import numpy as np
+
+from shared_mem_cache import SHM_DIR, NAMESPACE
+from stage_timer import (StageTimer, STAGE_ARTIST_SEARCH, STAGE_ARTIST_CLEANER, STAGE_ARTIST_LOAD_LOCAL,
+                         STAGE_ARTIST_LOAD_STORE, STAGE_ARTIST_LOAD_SHARED, STAGE_ARTIST_LOAD_BUILD,
+                         STAGE_ARTIST_LOAD_GLOBAL, STAGE_RECORDING_SEARCH, STAGE_RELEASE_SEARCH, STAGE_RESULT_FETCH,
+                         COUNTER_SQLITE_CONNECTIONS, COUNTER_EXACT_ARTIST_HITS, COUNTER_RESOLUTION_CACHE_HITS,
+                         COUNTER_RESOLUTION_CACHE_MISSES, COUNTER_ARTIST_CACHE_HITS, COUNTER_ARTIST_CACHE_MISSES)
+
+# Stage times and counters of all server processes, kept in one shared memory segment. Each process owns a
+# row of the segment and is the only one writing to it, so updates need no lock between processes. The
+# exported values are the sums over all rows. Rows of processes that exited are taken over by new processes,
+# which keep adding to them, so that the totals never go down.
+
+STAGES = (STAGE_ARTIST_SEARCH, STAGE_ARTIST_CLEANER, STAGE_ARTIST_LOAD_LOCAL, STAGE_ARTIST_LOAD_STORE,
+          STAGE_ARTIST_LOAD_SHARED, STAGE_ARTIST_LOAD_BUILD, STAGE_ARTIST_LOAD_GLOBAL, STAGE_RECORDING_SEARCH,
+          STAGE_RELEASE_SEARCH, STAGE_RESULT_FETCH)
+COUNTERS = (COUNTER_SQLITE_CONNECTIONS, COUNTER_EXACT_ARTIST_HITS, COUNTER_RESOLUTION_CACHE_HITS,
+            COUNTER_RESOLUTION_CACHE_MISSES, COUNTER_ARTIST_CACHE_HITS, COUNTER_ARTIST_CACHE_MISSES)
+
+# Upper bounds of the histogram buckets, in seconds. A last bucket counts the slower observations.
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+# Row layout: owner pid, the counters, then for each stage the number of observations, their sum in
+# nanoseconds and the bucket counts
+ROW_PID = 0
+ROW_COUNTERS = 1
+ROW_STAGES = ROW_COUNTERS + len(COUNTERS)
+STAGE_COUNT, STAGE_SUM = range(2)
+STAGE_FIELDS = 2 + len(BUCKETS) + 1
+ROW_FIELDS = ROW_STAGES + len(STAGES) * STAGE_FIELDS
+
+# More processes than this share the last row, which can lose some updates
+NUM_ROWS = 512
+
+PREFIX = "fast_fuzzy_"
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedMetrics(StageTimer):
+    """ A StageTimer that keeps histograms of the stage times and the counters in shared memory """
+
+    def __init__(self, namespace=NAMESPACE):
+        self.namespace = namespace
+        self.stages = { stage: ROW_STAGES + i * STAGE_FIELDS for i, stage in enumerate(STAGES) }
+        self.counters = { counter: ROW_COUNTERS + i for i, counter in enumerate(COUNTERS) }
+        self.lock = threading.Lock()
+        self.shm = None
+        self.rows = None
+        self.row = None
+        self.pid = None
+
+    @contextmanager
+    def locked(self):
+        """ Lock the row table against other processes, only needed to claim a row """
+        fd = os.open(os.path.join(SHM_DIR, self.namespace + "metrics.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def attach(self):
+        """ Open the metrics segment, creating it if this is the first process to use it. Call with the lock held. """
+        size = NUM_ROWS * ROW_FIELDS * 8
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.namespace + "metrics", create=True, size=size, track=False)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=self.namespace + "metrics", create=False, track=False)
+            if self.shm.size < size:
+                # Left behind by a version that kept fewer metrics
+                self.shm.close()
+                os.unlink(os.path.join(SHM_DIR, self.namespace + "metrics"))
+                self.shm = shared_memory.SharedMemory(name=self.namespace + "metrics", create=True, size=size, track=False)
+        self.rows = np.ndarray((NUM_ROWS, ROW_FIELDS), dtype=np.int64, buffer=self.shm.buf)
+
+    def own_row(self):
+        """
+            Return this process' row, claiming a free row or one of an exited process first. Checked on every
+            update, since server processes are forked after the metrics were created. Call with self.lock held.
+        """
+        pid = os.getpid()
+        if self.pid == pid:
+            return self.row
+
+        with self.locked():
+            if self.rows is None:
+                self.attach()
+            row = NUM_ROWS - 1
+            for i in range(NUM_ROWS):
+                owner = int(self.rows[i, ROW_PID])
+                if owner == 0 or owner == pid or not process_exists(owner):
+                    row = i
+                    break
+            self.rows[row, ROW_PID] = pid
+
+        self.row = self.rows[row]
+        self.pid = pid
+        return self.row
+
+    def observe(self, stage, seconds):
+        offset = self.stages.get(stage)
+        if offset is None:
+            return
+
+        bucket = bisect_left(BUCKETS, seconds)
+        with self.lock:
+            row = self.own_row()
+            row[offset + STAGE_COUNT] += 1
+            row[offset + STAGE_SUM] += int(seconds * 1e9)
+            row[offset + 2 + bucket] += 1
+
+    def count(self, counter, n=1):
+        offset = self.counters.get(counter)
+        if offset is None:
+            return
+
+        with self.lock:
+            self.own_row()[offset] += n
+
+    def totals(self):
+        """ Return the sums of all rows """
+        with self.lock:
+            if self.rows is None:
+                with self.locked():
+                    self.attach()
+            return self.rows.sum(axis=0)
+
+    def prometheus(self, cache_stats=None):
+        """ Return all metrics, and the artist cache stats if given, in the Prometheus text format """
+
+        totals = self.totals()
+        lines = [ "# HELP %sstage_seconds Time spent in each stage of a search" % PREFIX,
+                  "# TYPE %sstage_seconds histogram" % PREFIX ]
+        for stage, offset in self.stages.items():
+            cumulative = np.cumsum(totals[offset + 2:offset + STAGE_FIELDS])
+            for bound, count in zip(BUCKETS, cumulative):
+                lines.append('%sstage_seconds_bucket{stage="%s",le="%g"} %d' % (PREFIX, stage, bound, count))
+            lines.append('%sstage_seconds_bucket{stage="%s",le="+Inf"} %d' % (PREFIX, stage, cumulative[-1]))
+            lines.append('%sstage_seconds_sum{stage="%s"} %.9f' % (PREFIX, stage, totals[offset + STAGE_SUM] / 1e9))
+            lines.append('%sstage_seconds_count{stage="%s"} %d' % (PREFIX, stage, totals[offset + STAGE_COUNT]))
+
+        for counter, offset in self.counters.items():
+            lines.append("# TYPE %s%s_total counter" % (PREFIX, counter))
+            lines.append("%s%s_total %d" % (PREFIX, counter, totals[offset]))
+
+        if cache_stats is not None:
+            # The hits and misses of all processes are counters above, cache_stats only has this process'
+            lines.append("# TYPE %sartist_cache_evictions_total counter" % PREFIX)
+            lines.append("%sartist_cache_evictions_total %d" % (PREFIX, cache_stats["evictions"]))
+            for name in ("entries", "bytes", "max_bytes"):
+                lines.append("# TYPE %sartist_cache_%s gauge" % (PREFIX, name))
+                lines.append("%sartist_cache_%s %d" % (PREFIX, name, cache_stats[name]))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+from time import monotonic
+
+# The stages of a search that are timed
+STAGE_ARTIST_SEARCH = "artist_search"
+# The second artist search with cleaned names, part of artist_search
+STAGE_ARTIST_CLEANER = "artist_cleaner"
+STAGE_ARTIST_LOAD_LOCAL = "artist_load_local"
+STAGE_ARTIST_LOAD_STORE = "artist_load_store"
+STAGE_ARTIST_LOAD_SHARED = "artist_load_shared"
+STAGE_ARTIST_LOAD_BUILD = "artist_load_build"
+STAGE_ARTIST_LOAD_GLOBAL = "artist_load_global"
+STAGE_RECORDING_SEARCH = "recording_search"
+STAGE_RELEASE_SEARCH = "release_search"
+STAGE_RESULT_FETCH = "result_fetch"
+
+# Events that are counted
+# Read-only SQLite connections opened by the search path, which keeps them open
+COUNTER_SQLITE_CONNECTIONS = "sqlite_connections"
+COUNTER_EXACT_ARTIST_HITS = "exact_artist_hits"
+COUNTER_RESOLUTION_CACHE_HITS = "artist_resolution_cache_hits"
+COUNTER_RESOLUTION_CACHE_MISSES = "artist_resolution_cache_misses"
+COUNTER_ARTIST_CACHE_HITS = "artist_cache_hits"
+COUNTER_ARTIST_CACHE_MISSES = "artist_cache_misses"
+
+
+class StageTimer:
+    """
+        Receives the time spent in each stage of a search and counted events. This class discards them,
+        subclasses collect them for benchmarks or metrics.
+    """
+
+    def observe(self, stage, seconds):
+        pass
+
+    def count(self, counter, n=1):
+        pass
+
+    @contextmanager
+    def time(self, stage):
+        t0 = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, monotonic() - t0)
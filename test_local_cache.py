@@ -0,0 +1,56 @@
+import gc
+import os
+import unittest
+
+from artist_data import ArtistData, pack_artist_data
+from local_cache import LocalArtistDataCache
+from shared_mem_cache import SharedMemoryArtistDataCache, SHM_DIR
+
+
+def mapped_files():
+    with open("/proc/self/maps") as f:
+        return f.read()
+
+
+class LocalArtistDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.namespace = "ff_test%d_" % os.getpid()
+        self.data = ArtistData(pack_artist_data())
+        # Room for a single entry
+        self.cache = SharedMemoryArtistDataCache("/tmp", len(self.data.buffer), namespace=self.namespace)
+
+    def tearDown(self):
+        self.cache.clear_cache()
+        for name in ("meta", "lock", "build.lock"):
+            try:
+                os.unlink(os.path.join(SHM_DIR, self.namespace + name))
+            except FileNotFoundError:
+                pass
+
+    def test_evict_while_held(self):
+        local = LocalArtistDataCache(1024 * 1024)
+        self.cache.save(1, self.data)
+        local.put(1, self.cache.load(1), 0)
+        gc.collect()
+
+        # Saving another artist evicts artist 1 from the shared cache
+        self.cache.save(2, self.data)
+        self.assertIsNone(self.cache.load(1))
+        self.assertFalse(os.path.exists(os.path.join(SHM_DIR, self.cache.segment_name(1))))
+
+        # The local cache still has the artist, but doesn't keep the unlinked segment alive
+        data = local.get(1, 0)
+        self.assertIsNotNone(data)
+        self.assertTrue(data.is_empty)
+        self.assertNotIn(self.cache.segment_name(1), mapped_files())
+
+    def test_store_data_not_copied(self):
+        local = LocalArtistDataCache(1024 * 1024)
+        data = ArtistData(memoryview(self.data.buffer))
+        local.put(1, data, 0)
+        self.assertIs(local.get(1, 0), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
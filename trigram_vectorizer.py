@@ -0,0 +1,91 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# Each character of a trigram is a unicode code point, which fits in 21 bits. Packing the three code points
+# into one int64 gives every trigram a unique code and codes sort in the same order as the trigram strings,
+# so a sorted code array lines up column for column with TfidfVectorizer's sorted vocabulary.
+CODE_POINT_BITS = 21
+
+
+def trigram_codes(strings):
+    """
+        Compute the trigrams of a list of strings in one pass, with the same padding as utils.ngrams.
+        Returns (rows, codes): for every trigram, the index of the string it came from and its code.
+    """
+
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # Pad each string with a space on both sides and concatenate them
+    joined = " " + "  ".join(strings) + " "
+    points = np.frombuffer(joined.encode("utf-32-le", "surrogatepass"), dtype="<u4").astype(np.int64)
+    codes = (points[:-2] << (2 * CODE_POINT_BITS)) | (points[1:-1] << CODE_POINT_BITS) | points[2:]
+
+    # A string of length n has n trigrams, starting at its leading pad
+    starts = np.zeros(len(strings), dtype=np.int64)
+    np.cumsum(lengths[:-1] + 2, out=starts[1:])
+    firsts = np.zeros(len(strings), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=firsts[1:])
+    rows = np.repeat(np.arange(len(strings)), lengths)
+    positions = np.arange(total) + np.repeat(starts - firsts, lengths)
+
+    return rows, codes[positions]
+
+
+def trigram_code(trigram):
+    """ Return the code of a single trigram string """
+
+    a, b, c = [ ord(ch) for ch in trigram ]
+    return (a << (2 * CODE_POINT_BITS)) | (b << CODE_POINT_BITS) | c
+
+
+class TrigramVectorizer:
+    '''
+       A tf-idf vectorizer for the trigrams of encoded strings. It computes the same matrix as
+       TfidfVectorizer(min_df=1, analyzer=ngrams), but works on whole lists of strings with numpy and
+       keeps its vocabulary as a sorted array of trigram codes rather than a dict of strings.
+    '''
+
+    def __init__(self, vocabulary=None, idf=None):
+        self.vocabulary = vocabulary
+        self.idf = idf
+
+    def fit_transform(self, strings):
+        rows, codes = trigram_codes(strings)
+        if len(codes) == 0:
+            raise ValueError("empty vocabulary; strings contain no trigrams")
+
+        self.vocabulary, firsts, cols = np.unique(codes, return_index=True, return_inverse=True)
+        rows, cols, counts = self._count(rows, cols.ravel())
+        df = np.bincount(cols, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + len(strings)) / (1 + df)) + 1
+
+        # TfidfVectorizer sums each row's squares in the order the terms were first seen in the corpus,
+        # do the same to get bit for bit identical weights
+        return self._tfidf(rows, cols, counts, len(strings), order=np.lexsort((firsts[cols], rows)))
+
+    def transform(self, strings):
+        rows, codes = trigram_codes(strings)
+        cols = np.searchsorted(self.vocabulary, codes)
+        found = cols < len(self.vocabulary)
+        found[found] = self.vocabulary[cols[found]] == codes[found]
+        rows, cols, counts = self._count(rows[found], cols[found])
+
+        return self._tfidf(rows, cols, counts, len(strings))
+
+    def _count(self, rows, cols):
+        """ Count each (row, column) pair, returned sorted by row, then column """
+        pairs, counts = np.unique(rows * len(self.vocabulary) + cols, return_counts=True)
+        rows, cols = np.divmod(pairs, len(self.vocabulary))
+        return rows, cols, counts
+
+    def _tfidf(self, rows, cols, counts, num_rows, order=slice(None)):
+        weights = counts * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows[order], weights=(weights * weights)[order], minlength=num_rows))
+        weights /= norms[rows]
+        indptr = np.zeros(num_rows + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+
+        return csr_matrix((weights, cols.astype(np.int32), indptr), shape=(num_rows, len(self.vocabulary)))
@@ -1,3 +1,8 @@
+import os
+import shutil
+
+import numpy as np
+
 def ngrams(string, n=3):
     """ Take a lookup string (noise removed, lower case, etc) and turn into a list of trigrams """
 
@@ -43,3 +48,37 @@ def split_dict_evenly(index_dict, num_parts):
         split_flat_list[current][k] = v
 
     return split_flat_list
+
+def pack_strings(strings):
+    """ Pack a list of strings into an offsets array and a single utf-8 byte array """
+
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+def take_strings(offsets, packed, rows):
+    """ Return the offsets and bytes of a new table with the given rows of a table created by pack_strings() """
+
+    lengths = np.diff(offsets)[rows]
+    new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.arange(new_offsets[-1]) + np.repeat(offsets[rows] - new_offsets[:-1], lengths)
+    return new_offsets, packed[positions]
+
+def unpack_string(offsets, packed, i):
+    """ Return the i-th string from a table created by pack_strings() """
+
+    return packed[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+def replace_dir(tmp_path, path):
+    """
+        Move the directory tmp_path over path. Files that are memory mapped by running processes are never
+        overwritten: the old directory is renamed out of the way and removed once the new one is in place.
+    """
+
+    shutil.rmtree(path + ".old", ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, path + ".old")
+    os.rename(tmp_path, path)
+    shutil.rmtree(path + ".old", ignore_errors=True)
@@ -0,0 +1,5 @@
+from server import create_app
+
+# The app uWSGI serves: --module=wsgi --callable=app. It is created here rather than in server.py, so that
+# importing server doesn't load the indexes or start the cache manager process.
+app = create_app()